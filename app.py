@@ -1,5 +1,10 @@
 import chainlit as cl
-from openai_functions import openai_function_calling
+from chainlit.context import init_ws_context
+from openai_functions import openai_function_calling, start_outbox, queue_session_message
+import outbox
+import calcom_api
+import recorder
+import asyncio
 import os
 from dotenv import load_dotenv
 
@@ -7,6 +12,46 @@ load_dotenv()
 
 user_sessions = {}
 
+#where to deliver outbox results for each user: their chainlit session and the event loop it lives on
+outbox_listeners = {}
+
+async def send_outbox_result(session_id, content):
+    init_ws_context(session_id)
+    await cl.Message(content=content).send()
+
+def on_outbox_result(entry, result):
+    #runs on an outbox worker thread once a journaled mutation has finished for good
+    action = entry["operation"].replace("_", " ")
+    if entry["status"] == "done":
+        content = f"Your {action} request has gone through. Details: {calcom_api.summarize_result(result)}"
+    else:
+        error = result.get("error") if isinstance(result, dict) else result
+        content = f"Your {action} request could not be completed after {entry['attempts']} attempt(s): {error}"
+
+    #keeps the model aware of the outcome on the user's next turn
+    if entry["user_id"] in user_sessions:
+        queue_session_message(user_sessions[entry["user_id"]], {"role": "assistant", "content": content})
+
+    listener = outbox_listeners.get(entry["user_id"])
+    if listener:
+        session_id, loop = listener
+        asyncio.run_coroutine_threadsafe(send_outbox_result(session_id, content), loop)
+    else:
+        print(f"No active chat for {entry['user_id']} to deliver outbox result {entry['id']}: {content}")
+
+if outbox.is_enabled():
+    start_outbox(on_outbox_result)
+
+#one turn at a time per user, so a session's history is never written by two turns at once
+turn_locks = {}
+
+async def run_turn_off_loop(user_id, prompt, trace_id=None):
+    #turns block on the model, cal.com and per-tenant rate limits, so they run on a worker thread
+    #to keep the event loop free for other users; to_thread carries the contextvars along
+    lock = turn_locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        return await asyncio.to_thread(openai_function_calling, user_sessions, user_id, prompt, trace_id)
+
 @cl.on_chat_start
 async def on_chat_start():
     await cl.Message(
@@ -22,9 +67,9 @@ async def on_chat_start():
             content="OpenAI API key not found. Please set the OPENAI_API_KEY environment variable.",
         ).send()
     
-    if not os.getenv("CALCOM_API_KEY"):
+    if not (os.getenv("CALCOM_API_KEY") or os.getenv("CALCOM_API_KEYS") or os.getenv("CALCOM_CREDENTIAL_PROVIDER")):
         await cl.Message(
-            content="Cal.com API key not found. Please set the CALCOM_API_KEY environment variable.",
+            content="Cal.com API key not found. Please set the CALCOM_API_KEY environment variable (or CALCOM_API_KEYS / CALCOM_CREDENTIAL_PROVIDER for multiple accounts).",
         ).send()
 
 @cl.on_message
@@ -32,7 +77,9 @@ async def on_message(message: cl.Message):
     try:
         await cl.Message(content="").send()
         user_id = message.author or "default_user"
-        response = openai_function_calling(user_sessions, user_id, message.content)
+        outbox_listeners[user_id] = (cl.context.session.id, asyncio.get_running_loop())
+        trace_id = recorder.new_trace_id()
+        response = await run_turn_off_loop(user_id, message.content, trace_id)
         
         await cl.Message(content=response).send()
     
@@ -85,12 +132,12 @@ async def on_book_event(action):
 
 @cl.action_callback("view_events")
 async def on_view_events(action):
-    await cl.Message(content=openai_function_calling(user_sessions, "default_user", "help me view my scheduled events")).send()
+    await cl.Message(content=await run_turn_off_loop("default_user", "help me view my upcoming scheduled events")).send()
 
 @cl.action_callback("cancel_event")
 async def on_cancel_event(action):
-    await cl.Message(content=openai_function_calling(user_sessions, "default_user", "list all my scheduled events with their UIDs for me to select one to cancel")).send()
+    await cl.Message(content=await run_turn_off_loop("default_user", "list my upcoming scheduled events with their UIDs for me to select one to cancel")).send()
 
 @cl.action_callback("reschedule_event")
 async def on_reschedule_event(action):
-    await cl.Message(content=openai_function_calling(user_sessions, "default_user", "list all my scheduled events with their UIDs for me to select one to reschedule")).send()
\ No newline at end of file
+    await cl.Message(content=await run_turn_off_loop("default_user", "list my upcoming scheduled events with their UIDs for me to select one to reschedule")).send()
\ No newline at end of file
@@ -1,18 +1,28 @@
 import os
 import requests
+from urllib3.exceptions import NewConnectionError
 from dotenv import load_dotenv
 import datetime
 import time as time_module
 import pytz
 import re
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import tenants
+import recorder
 
 load_dotenv()
 
+BULK_MAX_WORKERS = int(os.getenv("CALCOM_BULK_MAX_WORKERS", "5"))
+EVENT_TYPES_TTL = int(os.getenv("CALCOM_EVENT_TYPES_TTL", "300"))
+SLOTS_TTL = int(os.getenv("CALCOM_SLOTS_TTL", "60"))
+BOOKINGS_TTL = int(os.getenv("CALCOM_BOOKINGS_TTL", "30"))
+#seconds to wait for cal.com to connect or answer, a slow upstream must not pin a worker forever
+CALCOM_TIMEOUT = float(os.getenv("CALCOM_TIMEOUT", "30"))
+
 def get_api_key():
-    api_key = os.getenv('CALCOM_API_KEY')
-    if not api_key:
-        raise ValueError("CALCOM_API_KEY is missing. Ensure it is set in the environment variables.")
-    return api_key
+    #the key belongs to whichever tenant the current turn runs for, see tenants.use_tenant
+    return tenants.get_tenant()["api_key"]
 
 def get_headers(api_version="2024-08-13"):
     api_key = get_api_key()
@@ -22,6 +32,62 @@ def get_headers(api_version="2024-08-13"):
         'cal-api-version': api_version
     }
 
+def calcom_request(method, url, api_version=None, params=None, json=None):
+    #v1 endpoints take the key as an apiKey query param, v2 endpoints want a Bearer header and an api version
+    #either way the call goes through the tenant's own connection pool and rate-limit bucket
+    tenant = tenants.get_tenant()
+    params = dict(params or {})
+    if api_version:
+        headers = get_headers(api_version=api_version)
+    else:
+        headers = {'Content-Type': 'application/json'}
+        params["apiKey"] = tenant["api_key"]
+
+    tenants.acquire(tenant)
+    if not recorder.current_turn.get():
+        return tenant["session"].request(method, url, headers=headers, params=params or None, json=json, timeout=CALCOM_TIMEOUT)
+
+    started = time_module.perf_counter()
+    entry = {"method": method, "url": url, "api_version": api_version, "params": recorder.redact_params(params), "json": json}
+    try:
+        response = tenant["session"].request(method, url, headers=headers, params=params or None, json=json, timeout=CALCOM_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        entry.update({"error": str(e), "duration_ms": round((time_module.perf_counter() - started) * 1000, 3)})
+        recorder.record("http", entry)
+        raise
+    entry.update({"status_code": response.status_code, "body": response.text, "duration_ms": round((time_module.perf_counter() - started) * 1000, 3)})
+    recorder.record("http", entry)
+    return response
+
+def is_connect_error(e):
+    #the connection was never established, so cal.com can't have seen the request
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(e, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+def request_error(message, e):
+    #the upstream status, or the kind of network failure, travels with the error so callers like the
+    #outbox can tell a request cal.com never saw from one it may already have acted on
+    error_detail = ""
+    failure = {}
+    if getattr(e, 'response', None) is not None:
+        error_detail = f" - Status: {e.response.status_code}, Details: {e.response.text}"
+        failure["status_code"] = e.response.status_code
+    elif is_connect_error(e):
+        failure["failure"] = "connect"
+    elif isinstance(e, requests.exceptions.Timeout):
+        failure["failure"] = "timeout"
+    elif isinstance(e, requests.exceptions.ConnectionError):
+        failure["failure"] = "disconnect"
+    return {"error": f"{message}: {str(e)}{error_detail}", "status": "error", **failure}
+
+def invalidate_booking_data():
+    #any booking mutation makes the cached booking lists, free slots and chat answers stale for this tenant
+    tenant = tenants.get_tenant()
+    tenants.cache_invalidate(tenant, "bookings", "slots")
+    tenants.bump_data_version(tenant)
+
 
 def normalize_timezone(timezone_str):
     timezone_mapping = {
@@ -75,21 +141,33 @@ def parse_date_time(date_str, timezone_str):
     
     return utc_dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
 
+def check_future(start_time):
+    #ISO times skip parse_date_time, they still must not reach cal.com when they are already past
+    try:
+        start_dt = datetime.datetime.strptime(start_time[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=pytz.UTC)
+    except ValueError:
+        raise ValueError(f"Could not parse date string: {start_time}")
+    if start_dt <= datetime.datetime.now(pytz.UTC):
+        raise ValueError("Booking time must be in the future.")
+
 def get_all_event_types():
     url = "https://api.cal.com/v2/event-types"
     
-    # Use the specific API version required for event types
-    headers = get_headers(api_version="2024-06-14")
+    tenant = tenants.get_tenant()
+    cached = tenants.cache_get(tenant, "event_types", "all")
+    if cached is not None:
+        return cached
     
     try:
-        response = requests.get(url, headers=headers)
+        # Use the specific API version required for event types
+        response = calcom_request("GET", url, api_version="2024-06-14")
         response.raise_for_status()
-        return response.json()
+        result = response.json()
+        tenants.cache_set(tenant, "event_types", "all", result, EVENT_TYPES_TTL)
+        return result
     except requests.exceptions.RequestException as e:
-        error_detail = ""
-        if hasattr(e, 'response') and e.response is not None:
-            error_detail = f" - Status: {e.response.status_code}, Details: {e.response.text}"
-        return {"error": f"Failed to get event types: {str(e)}{error_detail}", "status": "error"}
+        result = request_error("Failed to get event types", e)
+        return result
 
 def find_event_type_by_duration(duration):
     response = get_all_event_types()
@@ -111,8 +189,6 @@ def find_event_type_by_duration(duration):
 def create_event_type(title, slug, length_in_minutes):
     url = "https://api.cal.com/v2/event-types"
     
-    headers = get_headers(api_version="2024-06-14")
-    
     payload = {
         "title": title,
         "slug": slug,
@@ -123,22 +199,24 @@ def create_event_type(title, slug, length_in_minutes):
     print(f"Request payload: {payload}")
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = calcom_request("POST", url, api_version="2024-06-14", json=payload)
         print(f"Response status: {response.status_code}")
         print(f"Response body: {response.text}")
         
         response.raise_for_status()
+        tenants.cache_invalidate(tenants.get_tenant(), "event_types")
         return response.json()
     except requests.exceptions.RequestException as e:
-        error_detail = ""
-        if hasattr(e, 'response') and e.response is not None:
-            error_detail = f" - Status: {e.response.status_code}, Details: {e.response.text}"
-        print(f"Failed to create event type: {str(e)}{error_detail}")
-        return {"error": f"Failed to create event type: {str(e)}{error_detail}", "status": "error"}
+        result = request_error("Failed to create event type", e)
+        print(result["error"])
+        return result
 
 def get_or_create_event_type(duration):
     result = find_event_type_by_duration(duration)
     
+    if result["status"] == "error":
+        return result
+    
     if result["status"] == "success":
         print(f"Found existing event type: {result['message']}")
         return result
@@ -171,26 +249,30 @@ def get_available_slots(event_type_id, start_date, end_date):
     end_time = f"{end_date}T23:59:59Z"
     
     params = {
-        "apiKey": get_api_key(),
         "eventTypeId": event_type_id,
         "startTime": start_time,
         "endTime": end_time
     }
     
+    tenant = tenants.get_tenant()
+    cache_key = (event_type_id, start_date, end_date)
+    cached = tenants.cache_get(tenant, "slots", cache_key)
+    if cached is not None:
+        return cached
+    
     print(f"Getting available slots for event type {event_type_id}")
     
     try:
-        headers = {'Content-Type': 'application/json'}
-        response = requests.get(url, headers=headers, params=params)
+        response = calcom_request("GET", url, params=params)
         print(f"Response Status: {response.status_code}")
         
         response.raise_for_status()
-        return response.json()
+        result = response.json()
+        tenants.cache_set(tenant, "slots", cache_key, result, SLOTS_TTL)
+        return result
     except requests.exceptions.RequestException as e:
-        error_detail = ""
-        if hasattr(e, 'response') and e.response is not None:
-            error_detail = f" - Status: {e.response.status_code}, Details: {e.response.text}"
-        return {"error": f"Failed to get available slots: {str(e)}{error_detail}", "status": "error"}
+        result = request_error("Failed to get available slots", e)
+        return result
 
 def create_booking(event_type_id, start_time, attendee_name, attendee_email, attendee_timezone="America/New_York", duration=None):
     if duration is not None and (event_type_id is None or event_type_id == 0):
@@ -210,11 +292,13 @@ def create_booking(event_type_id, start_time, attendee_name, attendee_email, att
     
     attendee_timezone = normalize_timezone(attendee_timezone)
     
-    if not (start_time.endswith('Z') and 'T' in start_time):
-        try:
+    try:
+        if start_time.endswith('Z') and 'T' in start_time:
+            check_future(start_time)
+        else:
             start_time = parse_date_time(start_time, attendee_timezone)
-        except ValueError as e:
-            return {"error": str(e), "status": "error"}
+    except ValueError as e:
+        return {"error": str(e), "status": "error"}
     
 
     payload = {
@@ -233,76 +317,186 @@ def create_booking(event_type_id, start_time, attendee_name, attendee_email, att
         "metadata": {}
     }
     
-    params = {
-        "apiKey": get_api_key()
-    }
-    
     print(f"Creating booking for event type {event_type_id}")
     print(f"Payload: {payload}")
     
     try:
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(url, json=payload, headers=headers, params=params)
+        response = calcom_request("POST", url, json=payload)
         print(f"Response Status: {response.status_code}")
         print(f"Response Body: {response.text}")
         
         response.raise_for_status()
+        invalidate_booking_data()
         return response.json()
     except requests.exceptions.RequestException as e:
-        error_detail = ""
-        if hasattr(e, 'response') and e.response is not None:
-            error_detail = f" - Status: {e.response.status_code}, Details: {e.response.text}"
-        return {"error": f"Failed to create booking: {str(e)}{error_detail}", "status": "error"}
+        result = request_error("Failed to create booking", e)
+        return result
 
-def list_bookings():
-    url = "https://api.cal.com/v1/bookings"
-    
-    params = {
-        "apiKey": get_api_key()
+BOOKING_STATUSES = ["upcoming", "recurring", "past", "cancelled", "unconfirmed"]
+BOOKINGS_PAGE_SIZE = 100
+#cal.com only filters on the end time, so the upstream bound is widened by the longest booking we expect
+MAX_BOOKING_MINUTES = int(os.getenv("CALCOM_MAX_BOOKING_MINUTES", "1440"))
+
+def parse_booking_time(value):
+    return datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=pytz.UTC)
+
+def day_bounds_utc(start_date, end_date, timezone_str):
+    #turns YYYY-MM-DD dates in the user's timezone into the UTC instants cal.com filters on
+    tz = pytz.timezone(normalize_timezone(timezone_str))
+    after_start = before_end = None
+    if start_date:
+        local_start = tz.localize(datetime.datetime.strptime(start_date, "%Y-%m-%d"))
+        after_start = local_start.astimezone(pytz.UTC)
+    if end_date:
+        local_end = tz.localize(datetime.datetime.strptime(end_date, "%Y-%m-%d") + datetime.timedelta(days=1))
+        before_end = local_end.astimezone(pytz.UTC)
+    return after_start, before_end
+
+def booking_matches_status(booking, statuses, now_utc):
+    booking_status = (booking.get("status") or "").lower()
+    is_cancelled = booking_status in ("cancelled", "rejected")
+    is_past = parse_booking_time(booking["end"]) <= now_utc if booking.get("end") else False
+
+    for status in statuses:
+        if status == "cancelled" and is_cancelled:
+            return True
+        if status == "upcoming" and not is_cancelled and not is_past:
+            return True
+        if status == "past" and not is_cancelled and is_past:
+            return True
+        if status == "unconfirmed" and booking_status == "pending" and not is_past:
+            return True
+        if status == "recurring" and booking.get("recurringBookingUid") and not is_cancelled:
+            return True
+    return False
+
+def compact_booking(booking):
+    return {
+        "id": booking.get("id"),
+        "uid": booking.get("uid"),
+        "title": booking.get("title"),
+        "start": booking.get("start"),
+        "end": booking.get("end"),
+        "status": booking.get("status"),
+        "attendees": [
+            {"name": a.get("name"), "email": a.get("email"), "timeZone": a.get("timeZone")}
+            for a in booking.get("attendees", [])
+        ]
     }
-    
-    try:
-        headers = {'Content-Type': 'application/json'}
-        response = requests.get(url, headers=headers, params=params)
-        
+
+def iter_bookings(status=None, start_date=None, end_date=None, attendee_email=None, timezone_str="America/New_York", offset=0):
+    #yields (position, booking) pairs ordered by start time, one upstream page at a time
+    #status, date range and attendee are sent to cal.com and re-checked here in case the API ignores one
+    url = "https://api.cal.com/v2/bookings"
+
+    statuses = [s for s in (status or []) if s in BOOKING_STATUSES]
+    after_start, before_end = day_bounds_utc(start_date, end_date, timezone_str)
+
+    params = {"sortStart": "asc", "take": BOOKINGS_PAGE_SIZE}
+    if statuses:
+        params["status"] = ",".join(statuses)
+    if attendee_email:
+        params["attendeeEmail"] = attendee_email
+    if after_start:
+        params["afterStart"] = after_start.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    if before_end:
+        #a booking starting late on end_date may end after midnight, the local pass below bounds the start
+        upstream_end = before_end + datetime.timedelta(minutes=MAX_BOOKING_MINUTES)
+        params["beforeEnd"] = upstream_end.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+    now_utc = datetime.datetime.now(pytz.UTC)
+    position = offset
+    while True:
+        params["skip"] = position
+        response = calcom_request("GET", url, api_version="2024-08-13", params=params)
         response.raise_for_status()
-        return response.json()
+        page = response.json().get("data", [])
+
+        for booking in page:
+            position += 1
+            start = booking.get("start")
+            if not start:
+                continue
+            start_dt = parse_booking_time(start)
+            if after_start and start_dt < after_start:
+                continue
+            if before_end and start_dt >= before_end:
+                continue
+            if statuses and not booking_matches_status(booking, statuses, now_utc):
+                continue
+            if attendee_email:
+                emails = [(a.get("email") or "").lower() for a in booking.get("attendees", [])]
+                if attendee_email.lower() not in emails:
+                    continue
+            yield position, booking
+
+        if len(page) < BOOKINGS_PAGE_SIZE:
+            return
+
+def list_bookings(status=None, start_date=None, end_date=None, attendee_email=None, timezone_str="America/New_York", limit=20, cursor=None):
+    #limit=None pages through every match, the cursor is the opaque position returned as next_cursor
+    try:
+        offset = int(cursor) if cursor else 0
+    except (ValueError, TypeError):
+        return {"error": f"Invalid cursor: {cursor}", "status": "error"}
+
+    if isinstance(status, str):
+        status = [status]
+
+    tenant = tenants.get_tenant()
+    cache_key = (tuple(status or ()), start_date, end_date, attendee_email, timezone_str, limit, offset)
+    cached = tenants.cache_get(tenant, "bookings", cache_key)
+    if cached is not None:
+        return cached
+
+    bookings = []
+    next_cursor = None
+    try:
+        matches = iter_bookings(status, start_date, end_date, attendee_email, timezone_str, offset)
+        for position, booking in matches:
+            if limit is not None and len(bookings) == limit:
+                #one match beyond the limit tells us there is another page
+                next_cursor = str(position - 1)
+                break
+            bookings.append(compact_booking(booking))
+        matches.close()
+    except ValueError as e:
+        return {"error": str(e), "status": "error"}
     except requests.exceptions.RequestException as e:
-        error_detail = ""
-        if hasattr(e, 'response') and e.response is not None:
-            error_detail = f" - Status: {e.response.status_code}, Details: {e.response.text}"
-        return {"error": f"Failed to list bookings: {str(e)}{error_detail}", "status": "error"}
+        result = request_error("Failed to list bookings", e)
+        return result
+
+    bookings.sort(key=lambda b: b["start"])
+    result = {"status": "success", "bookings": bookings, "next_cursor": next_cursor}
+    tenants.cache_set(tenant, "bookings", cache_key, result, BOOKINGS_TTL)
+    return result
 
 
 def cancel_booking(booking_id):
     url = f"https://api.cal.com/v1/bookings/{booking_id}"
     
-    params = {
-        "apiKey": get_api_key()
-    }
-    
     try:
-        headers = {'Content-Type': 'application/json'}
-        response = requests.delete(url, headers=headers, params=params)
+        response = calcom_request("DELETE", url)
         
         response.raise_for_status()
+        invalidate_booking_data()
         return {"status": "success", "message": "Booking cancelled successfully"}
     except requests.exceptions.RequestException as e:
-        error_detail = ""
-        if hasattr(e, 'response') and e.response is not None:
-            error_detail = f" - Status: {e.response.status_code}, Details: {e.response.text}"
-        return {"error": f"Failed to cancel booking: {str(e)}{error_detail}", "status": "error"}
+        result = request_error("Failed to cancel booking", e)
+        return result
 
 def reschedule_booking(booking_uid, new_start_time, attendee_timezone="America/New_York"):
     url = f"https://api.cal.com/v2/bookings/{booking_uid}/reschedule"
     
     attendee_timezone = normalize_timezone(attendee_timezone)
     
-    if not (new_start_time.endswith('Z') and 'T' in new_start_time):
-        try:
+    try:
+        if new_start_time.endswith('Z') and 'T' in new_start_time:
+            check_future(new_start_time)
+        else:
             new_start_time = parse_date_time(new_start_time, attendee_timezone)
-        except ValueError as e:
-            return {"error": str(e), "status": "error"}
+    except ValueError as e:
+        return {"error": str(e), "status": "error"}
     
 
     payload = {
@@ -311,21 +505,132 @@ def reschedule_booking(booking_uid, new_start_time, attendee_timezone="America/N
         "reschedulingReason": "User wanted to reschedule"
     }
     
-    headers = get_headers(api_version="2024-08-13")
-    
     print(f"Rescheduling booking {booking_uid} to {new_start_time}")
     print(f"Payload: {payload}")
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = calcom_request("POST", url, api_version="2024-08-13", json=payload)
         print(f"Response Status: {response.status_code}")
         print(f"Response Body: {response.text}")
         
         response.raise_for_status()
+        invalidate_booking_data()
         return response.json()
     except requests.exceptions.RequestException as e:
-        error_detail = ""
-        if hasattr(e, 'response') and e.response is not None:
-            error_detail = f" - Status: {e.response.status_code}, Details: {e.response.text}"
-        return {"error": f"Failed to reschedule booking: {str(e)}{error_detail}", "status": "error"}
+        result = request_error("Failed to reschedule booking", e)
+        return result
+
+
+def find_bookings(start_date=None, end_date=None, attendee_email=None, timezone_str="America/New_York"):
+    #dates are YYYY-MM-DD and compared in the user's timezone so "Friday" means the user's Friday
+    return list_bookings(
+        status=["upcoming", "unconfirmed"],
+        start_date=start_date,
+        end_date=end_date,
+        attendee_email=attendee_email,
+        timezone_str=timezone_str,
+        limit=None
+    )
+
+def summarize_result(result):
+    if not isinstance(result, dict):
+        return {"status": "success"}
+    if "request_id" in result:
+        #an outbox acknowledgement, the item's real outcome follows once a worker has sent it
+        status = {"queued": "queued", "done": "success"}.get(result.get("status"), "error")
+        summary = {"status": status, "request_id": result["request_id"]}
+        if status == "error":
+            outcome = result.get("result") or {}
+            summary["error"] = outcome.get("error") or outcome.get("message") or result.get("error")
+        return summary
+    if result.get("status") == "error" or "error" in result:
+        return {"status": "error", "error": result.get("error") or result.get("message")}
+
+    data = result.get("data", result)
+    summary = {"status": "success"}
+    if isinstance(data, dict):
+        for key in ("id", "uid", "startTime", "start"):
+            if key in data:
+                summary[key] = data[key]
+    return summary
+
+def run_bulk(operation, items, max_workers=None):
+    #fans a single-item operation out over items with at most max_workers requests in flight
+    #operation(item) must return the usual result dict or an outbox acknowledgement; items come back in input order
+    if not items:
+        return {"status": "success", "total": 0, "succeeded": 0, "failed": 0, "results": []}
+
+    max_workers = max(1, min(max_workers or BULK_MAX_WORKERS, len(items)))
+
+    def run_one(item):
+        try:
+            return summarize_result(operation(item))
+        except Exception as e:
+            return {"status": "error", "error": str(e)}
+
+    #each item runs in a copy of the caller's context so the workers stay on the caller's tenant
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run_one, item) for item in items]
+        outcomes = [future.result() for future in futures]
+
+    results = []
+    for item, outcome in zip(items, outcomes):
+        results.append({"item": item, **outcome})
+
+    succeeded = sum(1 for r in results if r["status"] in ("success", "queued"))
+    failed = len(results) - succeeded
+    if failed == 0:
+        status = "queued" if any(r["status"] == "queued" for r in results) else "success"
+    elif succeeded == 0:
+        status = "error"
+    else:
+        status = "partial"
+
+    return {"status": status, "total": len(results), "succeeded": succeeded, "failed": failed, "results": results}
+
+def shift_start_time(start_time, minutes):
+    start_dt = datetime.datetime.strptime(start_time[:19], "%Y-%m-%dT%H:%M:%S")
+    return (start_dt + datetime.timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+def create_bookings(items, event_type_id=None, duration=None, attendee_timezone="America/New_York", coerce_start_time=None, max_workers=None):
+    #coerce_start_time(value, timezone) turns an item's time into a future ISO time or raises ValueError,
+    #it runs in the workers so slow formatting overlaps, and a bad time only fails its own item
+    #resolve the event type once up front, otherwise every worker would race to create its own
+    if duration is not None and (event_type_id is None or event_type_id == 0):
+        result = get_or_create_event_type(duration)
+        if result["status"] == "success" and "event_type_id" in result:
+            event_type_id = result["event_type_id"]
+        else:
+            return result
+
+    def create_one(item):
+        timezone_str = item.get("attendee_timezone") or attendee_timezone
+        start_time = item["start_time"]
+        if coerce_start_time:
+            start_time = coerce_start_time(start_time, timezone_str)
+        return create_booking(
+            event_type_id=event_type_id,
+            start_time=start_time,
+            attendee_name=item["attendee_name"],
+            attendee_email=item["attendee_email"],
+            attendee_timezone=timezone_str
+        )
+
+    return run_bulk(create_one, items, max_workers)
+
+def cancel_bookings(booking_ids, max_workers=None):
+    return run_bulk(cancel_booking, list(booking_ids), max_workers)
+
+def reschedule_bookings(items, attendee_timezone="America/New_York", coerce_start_time=None, max_workers=None):
+    def reschedule_one(item):
+        timezone_str = item.get("attendee_timezone") or attendee_timezone
+        new_start_time = item["new_start_time"]
+        if coerce_start_time:
+            new_start_time = coerce_start_time(new_start_time, timezone_str)
+        return reschedule_booking(
+            booking_uid=item["booking_uid"],
+            new_start_time=new_start_time,
+            attendee_timezone=timezone_str
+        )
 
+    return run_bulk(reschedule_one, items, max_workers)
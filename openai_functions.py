@@ -1,17 +1,326 @@
 import json
 import os
 from datetime import datetime, timedelta
+import pytz
 from openai import OpenAI
 from dotenv import load_dotenv
 import calcom_api
+import tool_registry
+import outbox
+import tenants
+import recorder
+import profiling
+import response_cache
+import time
+import threading
 
 
 load_dotenv()
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-functions = [
-    {
+queued_messages_lock = threading.Lock()
+
+def chat_completion(**kwargs):
+    #every model call goes through here so recorded turns capture the request, response and timing
+    if not recorder.current_turn.get():
+        return client.chat.completions.create(**kwargs)
+
+    started = time.perf_counter()
+    response = client.chat.completions.create(**kwargs)
+    request = dict(kwargs)
+    if "tools" in request:
+        #the schemas are static, their names are enough to tell which tool set was offered
+        request["tools"] = [tool["function"]["name"] for tool in request["tools"]]
+    recorder.record("llm_calls", {
+        "request": request,
+        "response": response,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 3)
+    })
+    return response
+
+def format_date_with_model(date_text, timezone, message_history=None):
+    if not message_history:
+        message_history = []
+        
+    system_message = (
+        "You are a date formatting assistant. Your sole job is to convert date and time strings "
+        "to ISO 8601 format with millisecond precision in UTC timezone. Output ONLY the ISO string "
+        "without any explanation or additional text. Format: YYYY-MM-DDTHH:MM:SS.000Z"
+    )
+    
+    prompt = (
+        f"Convert this date and time: '{date_text}' in timezone '{timezone}' to ISO 8601 format. "
+        f"Return ONLY the formatted date string in format 'YYYY-MM-DDTHH:MM:SS.000Z' in UTC timezone."
+    )
+    
+    messages = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": prompt}
+    ]
+    
+    try:
+        response = chat_completion(
+            model="gpt-4o",
+            messages=messages,
+            temperature=0.0, 
+            max_tokens=50
+        )
+        
+        formatted_date = response.choices[0].message.content.strip()
+        
+        if "T" in formatted_date and "Z" in formatted_date:
+            return formatted_date
+        else:
+            return calcom_api.parse_date_time(date_text, timezone)
+            
+    except Exception as e:
+        print(f"Error formatting date with model: {str(e)}")
+        return calcom_api.parse_date_time(date_text, timezone)
+
+def coerce_timezone(value, field="attendee_timezone"):
+    normalized = calcom_api.normalize_timezone(value)
+    try:
+        pytz.timezone(normalized)
+    except pytz.exceptions.UnknownTimeZoneError:
+        raise ValueError(f"{field} '{value}' is not a known timezone, use an IANA name such as 'America/New_York'")
+    return normalized
+
+def coerce_start_time(value, timezone, field="start_time"):
+    #human-readable times are formatted here so a past or unparseable time never reaches cal.com
+    if not (value.endswith('Z') and 'T' in value):
+        value = format_date_with_model(value, timezone)
+    try:
+        start_dt = datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=pytz.UTC)
+    except ValueError:
+        raise ValueError(f"{field} '{value}' is not a valid date and time, use a format like '10 April 2025 2pm'")
+    if start_dt <= datetime.now(pytz.UTC):
+        raise ValueError(f"{field} {value} is in the past, bookings must be in the future")
+    return start_dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+def check_iso_start_time(value, field):
+    #bulk items are formatted and checked in the workers (see coerce_item_start_time), but times that are
+    #already ISO can be checked up front so an obviously bad batch fails before anything is sent
+    if value.endswith('Z') and 'T' in value:
+        coerce_start_time(value, "UTC", field)
+
+def coerce_item_start_time(field):
+    #the per-item hook for the bulk tools, a ValueError fails only that item and names it in the results
+    return lambda value, timezone: coerce_start_time(value, timezone, field)
+
+def coerce_email(value, field="attendee_email"):
+    value = value.strip()
+    if "@" not in value or value.startswith("@") or value.endswith("@"):
+        raise ValueError(f"{field} '{value}' is not a valid email address")
+    return value
+
+def coerce_date(value, field):
+    if value is None:
+        return None
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"{field} '{value}' must be a date in YYYY-MM-DD format")
+    return value
+
+def coerce_filters(arguments):
+    arguments["start_date"] = coerce_date(arguments.get("start_date"), "start_date")
+    arguments["end_date"] = coerce_date(arguments.get("end_date"), "end_date")
+    if arguments.get("attendee_email"):
+        arguments["attendee_email"] = coerce_email(arguments["attendee_email"])
+    if arguments["start_date"] and arguments["end_date"] and arguments["start_date"] > arguments["end_date"]:
+        raise ValueError("start_date must not be after end_date")
+    return arguments
+
+def has_filters(arguments):
+    return bool(arguments.get("start_date") or arguments.get("end_date") or arguments.get("attendee_email"))
+
+def coerce_create_booking(arguments):
+    if arguments["event_type_id"] < 0 or arguments["duration"] < 0:
+        raise ValueError("event_type_id and duration must not be negative")
+    if arguments["event_type_id"] == 0 and arguments["duration"] == 0:
+        raise ValueError("set either event_type_id or duration")
+    arguments["attendee_timezone"] = coerce_timezone(arguments["attendee_timezone"])
+    arguments["attendee_email"] = coerce_email(arguments["attendee_email"])
+    arguments["start_time"] = coerce_start_time(arguments["start_time"], arguments["attendee_timezone"])
+    return arguments
+
+def coerce_list_bookings(arguments):
+    arguments["attendee_timezone"] = coerce_timezone(arguments["attendee_timezone"])
+    if arguments.get("limit") is not None and arguments["limit"] < 1:
+        raise ValueError("limit must be at least 1")
+    return coerce_filters(arguments)
+
+def coerce_reschedule_booking(arguments):
+    arguments["attendee_timezone"] = coerce_timezone(arguments["attendee_timezone"])
+    arguments["new_start_time"] = coerce_start_time(arguments["new_start_time"], arguments["attendee_timezone"], "new_start_time")
+    return arguments
+
+def coerce_create_bookings(arguments):
+    if arguments["event_type_id"] < 0 or arguments["duration"] < 0:
+        raise ValueError("event_type_id and duration must not be negative")
+    if arguments["event_type_id"] == 0 and arguments["duration"] == 0:
+        raise ValueError("set either event_type_id or duration")
+    if not arguments["bookings"]:
+        raise ValueError("bookings must contain at least one booking")
+    arguments["attendee_timezone"] = coerce_timezone(arguments["attendee_timezone"])
+    for i, item in enumerate(arguments["bookings"]):
+        item["attendee_email"] = coerce_email(item["attendee_email"], f"bookings[{i}].attendee_email")
+        check_iso_start_time(item["start_time"], f"bookings[{i}].start_time")
+    return arguments
+
+def coerce_cancel_bookings(arguments):
+    arguments["attendee_timezone"] = coerce_timezone(arguments["attendee_timezone"])
+    arguments = coerce_filters(arguments)
+    if not arguments.get("booking_ids") and not has_filters(arguments):
+        raise ValueError("provide booking_ids or at least one filter (start_date, end_date, attendee_email)")
+    return arguments
+
+def coerce_reschedule_bookings(arguments):
+    arguments["attendee_timezone"] = coerce_timezone(arguments["attendee_timezone"])
+    arguments = coerce_filters(arguments)
+    if arguments.get("bookings"):
+        for i, item in enumerate(arguments["bookings"]):
+            check_iso_start_time(item["new_start_time"], f"bookings[{i}].new_start_time")
+    elif not arguments.get("shift_minutes"):
+        raise ValueError("provide explicit bookings or a non-zero shift_minutes together with filters")
+    elif not has_filters(arguments):
+        raise ValueError("provide at least one filter (start_date, end_date, attendee_email) to select bookings to shift")
+    return arguments
+
+def handle_create_booking(arguments, context):
+    event_type_id = arguments["event_type_id"]
+
+    #if there is an event id we book it directly, otherwise the duration picks the event type
+    if event_type_id > 0:
+        return calcom_api.create_booking(
+            event_type_id=event_type_id,
+            start_time=arguments["start_time"],
+            attendee_name=arguments["attendee_name"],
+            attendee_email=arguments["attendee_email"],
+            attendee_timezone=arguments["attendee_timezone"]
+        )
+    return calcom_api.create_booking(
+        event_type_id=None,
+        start_time=arguments["start_time"],
+        attendee_name=arguments["attendee_name"],
+        attendee_email=arguments["attendee_email"],
+        attendee_timezone=arguments["attendee_timezone"],
+        duration=arguments["duration"]
+    )
+
+def handle_list_bookings(arguments, context):
+    limit = arguments.get("limit") or 20
+    return calcom_api.list_bookings(
+        status=arguments.get("status"),
+        start_date=arguments.get("start_date"),
+        end_date=arguments.get("end_date"),
+        attendee_email=arguments.get("attendee_email"),
+        timezone_str=arguments["attendee_timezone"],
+        limit=min(limit, 100),
+        cursor=arguments.get("cursor")
+    )
+
+def handle_cancel_booking(arguments, context):
+    return calcom_api.cancel_booking(arguments["booking_id"])
+
+def handle_reschedule_booking(arguments, context):
+    return calcom_api.reschedule_booking(
+        booking_uid=arguments["booking_uid"],
+        new_start_time=arguments["new_start_time"],
+        attendee_timezone=arguments["attendee_timezone"]
+    )
+
+def defer_items(context, function_name, items):
+    #in outbox mode a bulk call becomes one journaled single-booking request per item, so bulk mutations
+    #share the worker pool, retries and idempotency keys with single ones; items are validated in parallel
+    def defer_one(arguments):
+        try:
+            arguments = tool_registry.validate_arguments(function_name, arguments)
+        except ValueError as e:
+            return {"error": f"Invalid arguments for {function_name}: {str(e)}", "status": "error"}
+        return context["defer"](function_name, arguments)
+
+    return calcom_api.run_bulk(defer_one, items)
+
+def handle_create_bookings(arguments, context):
+    if context.get("defer"):
+        event_type_id = arguments["event_type_id"]
+        if not event_type_id:
+            #resolved once here, otherwise every journaled item would race to create its own event type
+            resolved = calcom_api.get_or_create_event_type(arguments["duration"])
+            if resolved["status"] != "success":
+                return resolved
+            event_type_id = resolved["event_type_id"]
+        return defer_items(context, "create_booking", [
+            {
+                "event_type_id": event_type_id,
+                "duration": 0,
+                "start_time": item["start_time"],
+                "attendee_name": item["attendee_name"],
+                "attendee_email": item["attendee_email"],
+                "attendee_timezone": arguments["attendee_timezone"]
+            }
+            for item in arguments["bookings"]
+        ])
+    return calcom_api.create_bookings(
+        items=arguments["bookings"],
+        event_type_id=arguments["event_type_id"] or None,
+        duration=arguments["duration"] or None,
+        attendee_timezone=arguments["attendee_timezone"],
+        coerce_start_time=coerce_item_start_time("start_time")
+    )
+
+def handle_cancel_bookings(arguments, context):
+    booking_ids = arguments.get("booking_ids")
+    if not booking_ids:
+        #no explicit ids so we resolve the filters against the booking list first
+        matched = calcom_api.find_bookings(
+            start_date=arguments.get("start_date"),
+            end_date=arguments.get("end_date"),
+            attendee_email=arguments.get("attendee_email"),
+            timezone_str=arguments["attendee_timezone"]
+        )
+        if matched.get("status") == "error":
+            return matched
+        booking_ids = [booking["id"] for booking in matched["bookings"]]
+    if context.get("defer"):
+        return defer_items(context, "cancel_booking", [{"booking_id": booking_id} for booking_id in booking_ids])
+    return calcom_api.cancel_bookings(booking_ids)
+
+def handle_reschedule_bookings(arguments, context):
+    items = arguments.get("bookings")
+    if not items:
+        matched = calcom_api.find_bookings(
+            start_date=arguments.get("start_date"),
+            end_date=arguments.get("end_date"),
+            attendee_email=arguments.get("attendee_email"),
+            timezone_str=arguments["attendee_timezone"]
+        )
+        if matched.get("status") == "error":
+            return matched
+        #shifted times get the same future check as explicit ones, before anything is sent to cal.com
+        items = []
+        for booking in matched["bookings"]:
+            new_start_time = calcom_api.shift_start_time(booking["start"], arguments["shift_minutes"])
+            try:
+                new_start_time = coerce_start_time(new_start_time, "UTC", f"new_start_time for booking {booking['uid']}")
+            except ValueError as e:
+                return {"error": f"Invalid arguments for reschedule_bookings: {str(e)}. Use a shift_minutes that keeps every booking in the future.", "status": "error"}
+            items.append({"booking_uid": booking["uid"], "new_start_time": new_start_time})
+    if context.get("defer"):
+        return defer_items(context, "reschedule_booking", [
+            {"booking_uid": item["booking_uid"], "new_start_time": item["new_start_time"], "attendee_timezone": arguments["attendee_timezone"]}
+            for item in items
+        ])
+    return calcom_api.reschedule_bookings(
+        items=items,
+        attendee_timezone=arguments["attendee_timezone"],
+        coerce_start_time=coerce_item_start_time("new_start_time")
+    )
+
+tool_registry.register_tool(
+    schema={
         "type": "function",
         "function": {
             "name": "create_booking",
@@ -50,21 +359,62 @@ functions = [
             "strict": True
         }
     },
-    {
+    coerce=coerce_create_booking,
+    handler=handle_create_booking,
+    mutation=True
+)
+
+tool_registry.register_tool(
+    schema={
         "type": "function",
         "function": {
             "name": "list_bookings",
-            "description": "List all scheduled bookings.",
+            "description": "List scheduled bookings ordered by start time. Narrow the request with the filters so only the bookings the user asked about are returned.",
             "parameters": {
                 "type": "object",
-                "properties": {},
-                "required": [],
+                "properties": {
+                    "status": {
+                        "type": ["array", "null"],
+                        "description": "Booking statuses to include, or null for every status. Use ['upcoming'] when the user asks what is on their calendar.",
+                        "items": {"type": "string", "enum": ["upcoming", "recurring", "past", "cancelled", "unconfirmed"]}
+                    },
+                    "start_date": {
+                        "type": ["string", "null"],
+                        "description": "Only include bookings starting on or after this date (YYYY-MM-DD, in attendee_timezone), or null."
+                    },
+                    "end_date": {
+                        "type": ["string", "null"],
+                        "description": "Only include bookings starting on or before this date (YYYY-MM-DD, in attendee_timezone), or null."
+                    },
+                    "attendee_email": {
+                        "type": ["string", "null"],
+                        "description": "Only include bookings with this attendee, or null."
+                    },
+                    "attendee_timezone": {
+                        "type": "string",
+                        "description": "Timezone used to interpret the date filters (e.g., 'America/New_York', 'Asia/Singapore')."
+                    },
+                    "limit": {
+                        "type": ["integer", "null"],
+                        "description": "Maximum number of bookings to return (at most 100), or null for the default of 20."
+                    },
+                    "cursor": {
+                        "type": ["string", "null"],
+                        "description": "The next_cursor value from a previous list_bookings result to fetch the following page, or null for the first page."
+                    }
+                },
+                "required": ["status", "start_date", "end_date", "attendee_email", "attendee_timezone", "limit", "cursor"],
                 "additionalProperties": False
             },
             "strict": True
         }
     },
-    {
+    coerce=coerce_list_bookings,
+    handler=handle_list_bookings
+)
+
+tool_registry.register_tool(
+    schema={
         "type": "function",
         "function": {
             "name": "cancel_booking",
@@ -83,7 +433,13 @@ functions = [
             "strict": True
         }
     },
-    {
+    coerce=None,
+    handler=handle_cancel_booking,
+    mutation=True
+)
+
+tool_registry.register_tool(
+    schema={
         "type": "function",
         "function": {
             "name": "reschedule_booking",
@@ -109,139 +465,284 @@ functions = [
             },
             "strict": True
         }
-    }
-]
+    },
+    coerce=coerce_reschedule_booking,
+    handler=handle_reschedule_booking,
+    mutation=True
+)
 
-def format_date_with_model(date_text, timezone, message_history=None):
-    if not message_history:
-        message_history = []
-        
-    system_message = (
-        "You are a date formatting assistant. Your sole job is to convert date and time strings "
-        "to ISO 8601 format with millisecond precision in UTC timezone. Output ONLY the ISO string "
-        "without any explanation or additional text. Format: YYYY-MM-DDTHH:MM:SS.000Z"
-    )
-    
-    prompt = (
-        f"Convert this date and time: '{date_text}' in timezone '{timezone}' to ISO 8601 format. "
-        f"Return ONLY the formatted date string in format 'YYYY-MM-DDTHH:MM:SS.000Z' in UTC timezone."
+tool_registry.register_tool(
+    schema={
+        "type": "function",
+        "function": {
+            "name": "create_bookings",
+            "description": "Book several events in one go, e.g. the same kind of meeting with several different people. Use this instead of repeated create_booking calls.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "event_type_id": {
+                        "type": "integer",
+                        "description": "The ID of the event type to book for every item, or 0 if you're specifying a custom duration instead."
+                    },
+                    "duration": {
+                        "type": "integer",
+                        "description": "Custom duration of every meeting in minutes, or 0 if you're using a specific event_type_id instead."
+                    },
+                    "attendee_timezone": {
+                        "type": "string",
+                        "description": "Timezone the start times are given in (e.g., 'America/New_York', 'Asia/Singapore')."
+                    },
+                    "bookings": {
+                        "type": "array",
+                        "description": "One entry per booking to create.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "start_time": {
+                                    "type": "string",
+                                    "description": "Start time in a human-readable format (e.g., '10 April 2025 2pm') or ISO 8601 format."
+                                },
+                                "attendee_name": {
+                                    "type": "string",
+                                    "description": "Name of the attendee."
+                                },
+                                "attendee_email": {
+                                    "type": "string",
+                                    "description": "Email of the attendee."
+                                }
+                            },
+                            "required": ["start_time", "attendee_name", "attendee_email"],
+                            "additionalProperties": False
+                        }
+                    }
+                },
+                "required": ["event_type_id", "duration", "attendee_timezone", "bookings"],
+                "additionalProperties": False
+            },
+            "strict": True
+        }
+    },
+    coerce=coerce_create_bookings,
+    handler=handle_create_bookings
+)
+
+tool_registry.register_tool(
+    schema={
+        "type": "function",
+        "function": {
+            "name": "cancel_bookings",
+            "description": "Cancel several bookings at once, either by listing their IDs or by a filter such as a date range and/or attendee email (e.g. 'cancel all my meetings on Friday').",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "booking_ids": {
+                        "type": ["array", "null"],
+                        "description": "IDs of the bookings to cancel, or null to select bookings with the filters instead.",
+                        "items": {"type": "integer"}
+                    },
+                    "start_date": {
+                        "type": ["string", "null"],
+                        "description": "Only match bookings on or after this date (YYYY-MM-DD, in attendee_timezone), or null."
+                    },
+                    "end_date": {
+                        "type": ["string", "null"],
+                        "description": "Only match bookings on or before this date (YYYY-MM-DD, in attendee_timezone), or null."
+                    },
+                    "attendee_email": {
+                        "type": ["string", "null"],
+                        "description": "Only match bookings with this attendee, or null."
+                    },
+                    "attendee_timezone": {
+                        "type": "string",
+                        "description": "Timezone used to interpret the date filters (e.g., 'America/New_York', 'Asia/Singapore')."
+                    }
+                },
+                "required": ["booking_ids", "start_date", "end_date", "attendee_email", "attendee_timezone"],
+                "additionalProperties": False
+            },
+            "strict": True
+        }
+    },
+    coerce=coerce_cancel_bookings,
+    handler=handle_cancel_bookings
+)
+
+tool_registry.register_tool(
+    schema={
+        "type": "function",
+        "function": {
+            "name": "reschedule_bookings",
+            "description": "Reschedule several bookings at once, either to explicit new times or by shifting every booking matched by a date range and/or attendee filter by a fixed number of minutes.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "bookings": {
+                        "type": ["array", "null"],
+                        "description": "Explicit bookings to move, or null to select bookings with the filters instead.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "booking_uid": {
+                                    "type": "string",
+                                    "description": "The unique identifier (UID) of the booking to reschedule."
+                                },
+                                "new_start_time": {
+                                    "type": "string",
+                                    "description": "New start time in a human-readable format (e.g., '10 April 2025 2pm') or ISO 8601 format. Must be in the future."
+                                }
+                            },
+                            "required": ["booking_uid", "new_start_time"],
+                            "additionalProperties": False
+                        }
+                    },
+                    "start_date": {
+                        "type": ["string", "null"],
+                        "description": "Only match bookings on or after this date (YYYY-MM-DD, in attendee_timezone), or null."
+                    },
+                    "end_date": {
+                        "type": ["string", "null"],
+                        "description": "Only match bookings on or before this date (YYYY-MM-DD, in attendee_timezone), or null."
+                    },
+                    "attendee_email": {
+                        "type": ["string", "null"],
+                        "description": "Only match bookings with this attendee, or null."
+                    },
+                    "shift_minutes": {
+                        "type": ["integer", "null"],
+                        "description": "Minutes to move every filtered booking by (negative moves earlier, 1440 is one day later), or null when explicit bookings are given."
+                    },
+                    "attendee_timezone": {
+                        "type": "string",
+                        "description": "Timezone of the attendee (e.g., 'America/New_York', 'Asia/Singapore')."
+                    }
+                },
+                "required": ["bookings", "start_date", "end_date", "attendee_email", "shift_minutes", "attendee_timezone"],
+                "additionalProperties": False
+            },
+            "strict": True
+        }
+    },
+    coerce=coerce_reschedule_bookings,
+    handler=handle_reschedule_bookings
+)
+
+#the schemas sent to OpenAI, built once from the registry at startup
+functions = tool_registry.tool_schemas()
+
+def defer_to_outbox(user_id, function_name, arguments, tenant_id=None):
+    entry = outbox.enqueue(user_id or "default_user", function_name, arguments, tenant_id=tenant_id)
+    if entry.get("duplicate") and entry["status"] in ("done", "failed"):
+        result = {"status": entry["status"], "request_id": entry["id"], "result": entry["result"],
+                  "message": "This exact request was already processed a moment ago, here is its outcome."}
+    else:
+        result = {
+            "status": "queued",
+            "request_id": entry["id"],
+            "message": (
+                f"The {function_name.replace('_', ' ')} request was accepted and is being sent to Cal.com in the background. "
+                "The user will get a follow-up message with the final outcome."
+            )
+        }
+    #bulk tools defer one item at a time from inside their handler, so replay needs every acknowledgement
+    recorder.record("deferred", {"name": function_name, "arguments": arguments, "result": result})
+    return result
+
+def find_created_booking(arguments):
+    #a create_booking attempt that timed out may still have gone through, so before it is sent again
+    #we look for a booking with the same attendee at the same start time
+    tenants.cache_invalidate(tenants.get_tenant(), "bookings")
+    start_time = arguments["start_time"]
+    matched = calcom_api.find_bookings(
+        start_date=start_time[:10],
+        end_date=start_time[:10],
+        attendee_email=arguments["attendee_email"],
+        timezone_str="UTC"
     )
-    
-    messages = [
-        {"role": "system", "content": system_message},
-        {"role": "user", "content": prompt}
-    ]
-    
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.0, 
-            max_tokens=50
-        )
-        
-        formatted_date = response.choices[0].message.content.strip()
-        
-        if "T" in formatted_date and "Z" in formatted_date:
-            return formatted_date
-        else:
-            return calcom_api.parse_date_time(date_text, timezone)
-            
-    except Exception as e:
-        print(f"Error formatting date with model: {str(e)}")
-        return calcom_api.parse_date_time(date_text, timezone)
+    if matched.get("status") == "error":
+        return {"error": f"Could not check whether an earlier attempt went through: {matched['error']}", "status": "error", "failure": "unknown"}
+    for booking in matched["bookings"]:
+        if booking["start"][:19] == start_time[:19]:
+            return {"status": "success", "data": booking, "message": "An earlier attempt had already created this booking"}
+    return None
+
+def start_outbox(notify=None):
+    #the workers run the same handlers as the inline path, on arguments validated before journaling
+    operations = {
+        name: (lambda args, name=name: tool_registry.run_handler(name, args))
+        for name in tool_registry.tools
+        if tool_registry.is_mutation(name)
+    }
+    #cancelling twice can't do any harm, creates are checked for before a resend and a reschedule
+    #with an unknown outcome is reported back instead of being sent again
+    outbox.start(operations, notify, idempotent={"cancel_booking"}, reconcilers={"create_booking": find_created_booking})
 
 #the earlier version of the function was using user_prompts, we keep the variable passed for future modifications
-def handle_function_call(function_name, arguments, user_prompt=""):
+def handle_function_call(function_name, arguments, user_prompt="", user_id=None):
     #print statements to debug what functions are called and with what arguments
     print(f"Handling function call: {function_name}")
     print(f"Arguments: {arguments}")
     
+    context = {"user_prompt": user_prompt, "user_id": user_id}
+    if outbox.is_enabled():
+        tenant_id = tenants.current_tenant_id.get()
+        context["defer"] = lambda name, args: defer_to_outbox(user_id, name, args, tenant_id)
+
     try:
-        if function_name == "create_booking":
-            event_type_id = arguments.get("event_type_id", 0)
-            duration = arguments.get("duration", 30)
-            start_time = arguments.get("start_time")
-            attendee_name = arguments.get("attendee_name")
-            attendee_email = arguments.get("attendee_email")
-            attendee_timezone = arguments.get("attendee_timezone", "America/New_York")
-            
-            try:
-                if not (start_time.endswith('Z') and 'T' in start_time):
-                    formatted_start_time = format_date_with_model(start_time, attendee_timezone)
-                else:
-                    formatted_start_time = start_time
-                
-                print(f"Original start time: {start_time}")
-                print(f"Formatted start time: {formatted_start_time}")
-            except Exception as e:
-                print(f"Error formatting start time with model: {str(e)}")
-                formatted_start_time = start_time
-            
-            #if there is an event id 
-            if event_type_id and event_type_id > 0:
-                return calcom_api.create_booking(
-                    event_type_id=event_type_id,
-                    start_time=formatted_start_time,
-                    attendee_name=attendee_name,
-                    attendee_email=attendee_email,
-                    attendee_timezone=attendee_timezone
-                )
-            else:
-                return calcom_api.create_booking(
-                    event_type_id=None,
-                    start_time=formatted_start_time,
-                    attendee_name=attendee_name,
-                    attendee_email=attendee_email,
-                    attendee_timezone=attendee_timezone,
-                    duration=duration
-                )
-            
-        
-        elif function_name == "list_bookings":
-            return calcom_api.list_bookings()
-        
-        elif function_name == "cancel_booking":
-            booking_id = arguments.get("booking_id")
-            return calcom_api.cancel_booking(booking_id)
-        
-        elif function_name == "reschedule_booking":
-            booking_uid = arguments.get("booking_uid")
-            new_start_time = arguments.get("new_start_time")
-            attendee_timezone = arguments.get("attendee_timezone", "America/New_York")
-        
-            try:
-                formatted_start_time = format_date_with_model(new_start_time, attendee_timezone)
-                print(f"Formatted new start time: {formatted_start_time}")
-            except Exception as e:
-                print(f"Error formatting new start time: {str(e)}")
-                formatted_start_time = new_start_time
-                
-            return calcom_api.reschedule_booking(
-                booking_uid=booking_uid,
-                new_start_time=formatted_start_time,
-                attendee_timezone=attendee_timezone
-            )
-        
-        else:
-            return {"error": f"Unknown function: {function_name}"}
+        if not recorder.current_turn.get():
+            return tool_registry.dispatch(function_name, arguments, context)
+
+        started = time.perf_counter()
+        result = tool_registry.dispatch(function_name, arguments, context)
+        recorder.record("tool_calls", {
+            "name": function_name,
+            "arguments": arguments,
+            "result": result,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3)
+        })
+        return result
     
     except Exception as e:
         print(f"Error in function call: {str(e)}")
         return {"error": f"Error executing {function_name}: {str(e)}"}
 
-def openai_function_calling(user_sessions, user_id, prompt):
+def openai_function_calling(user_sessions, user_id, prompt, trace_id=None):
 
     #we save user sessions with pending functions and parameters to ensure that the user can continue providing inputs
     if user_id not in user_sessions:
         user_sessions[user_id] = {
             "conversation_history": [],
             "pending_function": None,
-            "pending_params": {}
+            "pending_params": {},
+            "tenant_id": tenants.resolve_tenant_id(user_id)
         }
     
     session = user_sessions[user_id]
 
+    trace_id = trace_id or recorder.new_trace_id()
+
+    #every cal.com call made during this turn runs against the session's tenant
+    with tenants.use_tenant(session.get("tenant_id")):
+        with profiling.profile_turn(trace_id, user_id, session):
+            with recorder.record_turn(trace_id, user_id, prompt, session):
+                response = run_turn(session, user_id, prompt)
+                recorder.set_response(response)
+                return response
+
+def queue_session_message(session, message):
+    #called from outbox workers, the message only joins the history at the start of the user's next turn
+    with queued_messages_lock:
+        session.setdefault("queued_messages", []).append(message)
+
+def merge_queued_messages(session):
+    #merging between turns keeps tool_calls messages directly followed by their tool replies
+    with queued_messages_lock:
+        queued = session.get("queued_messages") or []
+        session["queued_messages"] = []
+    session["conversation_history"].extend(queued)
+
+def run_turn(session, user_id, prompt):
+
+    merge_queued_messages(session)
 
     #we are adding user's latest message to conversation history, ensuring their new input becomes part of the context
     session["conversation_history"].append({"role": "user", "content": prompt})
@@ -267,7 +768,7 @@ def openai_function_calling(user_sessions, user_id, prompt):
         })
         
         # extracting parameters 
-        response = client.chat.completions.create(
+        response = chat_completion(
             model="gpt-4o",
             messages=messages,
             tools=functions,
@@ -280,57 +781,63 @@ def openai_function_calling(user_sessions, user_id, prompt):
             current_params.update(new_args)
             
             
-            for f in functions:
-                if f["function"]["name"] == function_name:
-                    required_fields = f["function"]["parameters"].get("required", [])
-                    missing_fields = [field for field in required_fields if field not in current_params]
-                    
-                    if not missing_fields:
-                        function_result = handle_function_call(function_name, current_params, prompt)
-                        
-                        #records that GPT decided to call a function X with certain parameters
-                        session["conversation_history"].append({
-                            "role": "assistant",
-                            "content": None,
-                            "tool_calls": [
-                                {
-                                    "id": "call_" + function_name,
-                                    "type": "function",
-                                    "function": {
-                                        "name": function_name,
-                                        "arguments": json.dumps(current_params)
-                                    }
-                                }
-                            ]
-                        })
-                        
-                        #records the result of executing the function in the conversation history where tool_call_id matches id from above
-                        session["conversation_history"].append({
-                            "role": "tool",
-                            "tool_call_id": "call_" + function_name,
-                            "content": json.dumps(function_result)
-                        })
-                        
-                        
-                        session["pending_function"] = None
-                        session["pending_params"] = {}
-                        
-
-                        final_response = client.chat.completions.create(
-                            model="gpt-4o",
-                            messages=session["conversation_history"]
-                        )
-                        
-                        response_message = final_response.choices[0].message
-                        session["conversation_history"].append(response_message)
-                        
-                        return response_message.content
-                    else:
-                        missing_str = ", ".join(missing_fields)
-                        return f"I still need the following information to {function_name.replace('_', ' ')}: {missing_str}"
+            missing_fields = tool_registry.missing_fields(function_name, current_params)
+            
+            if not missing_fields:
+                function_result = handle_function_call(function_name, current_params, prompt, user_id)
+                
+                #records that GPT decided to call a function X with certain parameters
+                session["conversation_history"].append({
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": [
+                        {
+                            "id": "call_" + function_name,
+                            "type": "function",
+                            "function": {
+                                "name": function_name,
+                                "arguments": json.dumps(current_params)
+                            }
+                        }
+                    ]
+                })
+                
+                #records the result of executing the function in the conversation history where tool_call_id matches id from above
+                session["conversation_history"].append({
+                    "role": "tool",
+                    "tool_call_id": "call_" + function_name,
+                    "content": json.dumps(function_result)
+                })
+                
+                
+                session["pending_function"] = None
+                session["pending_params"] = {}
+                
+
+                final_response = chat_completion(
+                    model="gpt-4o",
+                    messages=session["conversation_history"]
+                )
+                
+                response_message = final_response.choices[0].message
+                session["conversation_history"].append(response_message)
+                
+                return response_message.content
+            else:
+                missing_str = ", ".join(missing_fields)
+                return f"I still need the following information to {function_name.replace('_', ' ')}: {missing_str}"
     
     
     #we assume here that there are no pending functions
+    #repeated read-only questions are answered from the cache while the tenant's booking data is unchanged
+    cache_key = response_cache.make_key(user_id, prompt, session.get("timezone"))
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None:
+        print(f"Response cache hit for {user_id}: {response_cache.stats()}")
+        recorder.mark_cache_hit()
+        session["conversation_history"].append({"role": "assistant", "content": cached_response})
+        return cached_response
+
     messages = session["conversation_history"].copy()
     
     messages.insert(0, {
@@ -350,13 +857,20 @@ def openai_function_calling(user_sessions, user_id, prompt):
             "verify the current date to ensure accuracy. Always confirm actions before executing them "
             "and explain the outcomes clearly to the user."
             "For reschedule_booking, you'll need the booking UID from a previous list_bookings call. "
+            "When listing bookings, pass filters (status, dates, attendee) that match what the user asked about "
+            "instead of fetching everything, and only request the next page with next_cursor if the user needs it. "
             "When listing bookings, always point out the 'uid' or 'reschedule_uid' field to the user "
             "and explain they'll need this value to reschedule the meeting. "
             "Ask users to list their bookings first if they want to reschedule but don't provide a booking UID. "
+            "If a tool result has status 'queued', tell the user the request was accepted and that they will get "
+            "a follow-up message once Cal.com confirms it, do not claim it already succeeded. "
+            "When a request covers several bookings at once (e.g. 'cancel all my meetings on Friday' or "
+            "'book 30-minute slots with these five people'), use the bulk tools create_bookings, cancel_bookings "
+            "or reschedule_bookings in a single call instead of calling the single-booking tools repeatedly. "
         )
     })
     
-    response = client.chat.completions.create(
+    response = chat_completion(
         model="gpt-4o",
         messages=messages,
         tools=functions,
@@ -376,12 +890,7 @@ def openai_function_calling(user_sessions, user_id, prompt):
             function_name = tool_call.function.name
             function_args = json.loads(tool_call.function.arguments)
             
-            missing_fields = []
-            for f in functions:
-                if f["function"]["name"] == function_name:
-                    required_fields = f["function"]["parameters"].get("required", [])
-                    missing_fields = [field for field in required_fields if field not in function_args]
-                    break
+            missing_fields = tool_registry.missing_fields(function_name, function_args)
             
             #if there are missing fields, we instantiate the session pending function and pending params fields
             if missing_fields:
@@ -391,10 +900,15 @@ def openai_function_calling(user_sessions, user_id, prompt):
                 return f"To {function_name.replace('_', ' ')}, I need the following information: {missing_str}"
             
 
-            function_result = handle_function_call(function_name, function_args, prompt)
+            function_result = handle_function_call(function_name, function_args, prompt, user_id)
+            if function_name in response_cache.READ_ONLY_TOOLS and not (isinstance(function_result, dict) and "error" in function_result):
+                #the cache needs the arguments as the tool saw them, and the timezone they ran in for later keys
+                function_args = tool_registry.validate_arguments(function_name, function_args)
+                session["timezone"] = function_args["attendee_timezone"]
             function_responses.append({
                 "tool_call_id": tool_call.id,
                 "function_name": function_name,
+                "arguments": function_args,
                 "result": function_result
             })
             
@@ -405,7 +919,7 @@ def openai_function_calling(user_sessions, user_id, prompt):
                 "content": json.dumps(function_result)
             })
         
-        final_response = client.chat.completions.create(
+        final_response = chat_completion(
             model="gpt-4o",
             messages=session["conversation_history"]
         )
@@ -413,6 +927,11 @@ def openai_function_calling(user_sessions, user_id, prompt):
         final_message = final_response.choices[0].message
         session["conversation_history"].append(final_message)
         
+        read_calls = [(response["function_name"], response["arguments"]) for response in function_responses]
+        failed = any(isinstance(r["result"], dict) and "error" in r["result"] for r in function_responses)
+        if response_cache.is_cacheable_turn(cache_key, read_calls) and not failed:
+            response_cache.put(cache_key, final_message.content)
+        
         return final_message.content
     
     
@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+from dotenv import load_dotenv
+import tenants
+
+load_dotenv()
+
+#the outbox journals booking mutations to sqlite so the user's turn doesn't wait on cal.com
+#workers drain the journal with retries and report the final outcome through the notify callback
+
+OUTBOX_PATH = os.getenv("CALCOM_OUTBOX_PATH", "outbox.db")
+OUTBOX_WORKERS = int(os.getenv("CALCOM_OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("CALCOM_OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_DELAY = float(os.getenv("CALCOM_OUTBOX_RETRY_DELAY", "2"))
+#identical intents from the same user inside this window are treated as one request
+OUTBOX_IDEMPOTENCY_WINDOW = int(os.getenv("CALCOM_OUTBOX_IDEMPOTENCY_WINDOW", "600"))
+
+INTERRUPTED_RESULT = {"error": "Interrupted by a restart before Cal.com answered", "status": "error", "failure": "unknown"}
+
+state = {
+    "operations": {},
+    "idempotent": set(),
+    "reconcilers": {},
+    "notify": None,
+    "workers": [],
+    "stopping": threading.Event(),
+    "wakeup": threading.Event()
+}
+local = threading.local()
+
+def is_enabled():
+    return os.getenv("CALCOM_OUTBOX_ENABLED", "").lower() in ("1", "true", "yes")
+
+def get_connection():
+    #sqlite connections can't be shared between threads, so each worker keeps its own
+    connection = getattr(local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(OUTBOX_PATH, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        local.connection = connection
+    return connection
+
+def init_db():
+    connection = get_connection()
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id TEXT PRIMARY KEY,
+            idempotency_key TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            tenant_id TEXT NOT NULL DEFAULT 'default',
+            operation TEXT NOT NULL,
+            arguments TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL
+        )
+    """)
+    columns = [row["name"] for row in connection.execute("PRAGMA table_info(outbox)")]
+    if "tenant_id" not in columns:
+        connection.execute("ALTER TABLE outbox ADD COLUMN tenant_id TEXT NOT NULL DEFAULT 'default'")
+    connection.execute("CREATE INDEX IF NOT EXISTS outbox_key ON outbox (idempotency_key, created_at)")
+    connection.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+    #anything left running by a previous process never reported back, cal.com may or may not have acted on it,
+    #so it goes round again marked as an unknown outcome and process decides whether it's safe to resend
+    connection.execute(
+        "UPDATE outbox SET status = 'pending', result = ? WHERE status = 'running'",
+        (json.dumps(INTERRUPTED_RESULT),)
+    )
+
+def row_to_entry(row):
+    entry = dict(row)
+    entry["arguments"] = json.loads(entry["arguments"])
+    entry["result"] = json.loads(entry["result"]) if entry["result"] else None
+    return entry
+
+def make_idempotency_key(user_id, operation, arguments, tenant_id=tenants.DEFAULT_TENANT):
+    canonical = json.dumps([tenant_id, user_id, operation, arguments], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def enqueue(user_id, operation, arguments, idempotency_key=None, tenant_id=None):
+    if operation not in state["operations"]:
+        raise ValueError(f"Operation {operation} is not handled by the outbox")
+
+    tenant_id = tenant_id or tenants.DEFAULT_TENANT
+    key = idempotency_key or make_idempotency_key(user_id, operation, arguments, tenant_id)
+    now = time.time()
+    connection = get_connection()
+
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            "SELECT * FROM outbox WHERE idempotency_key = ? AND created_at > ? AND status != 'failed' "
+            "ORDER BY created_at DESC LIMIT 1",
+            (key, now - OUTBOX_IDEMPOTENCY_WINDOW)
+        ).fetchone()
+        if row is not None:
+            connection.execute("COMMIT")
+            entry = row_to_entry(row)
+            entry["duplicate"] = True
+            return entry
+
+        entry_id = uuid.uuid4().hex
+        connection.execute(
+            "INSERT INTO outbox (id, idempotency_key, user_id, tenant_id, operation, arguments, status, attempts, created_at, updated_at, next_attempt_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'pending', 0, ?, ?, ?)",
+            (entry_id, key, user_id, tenant_id, operation, json.dumps(arguments), now, now, now)
+        )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+    state["wakeup"].set()
+    return get_entry(entry_id)
+
+def get_entry(entry_id):
+    row = get_connection().execute("SELECT * FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+    return row_to_entry(row) if row else None
+
+def claim_next():
+    connection = get_connection()
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            "SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1",
+            (now,)
+        ).fetchone()
+        if row is None:
+            connection.execute("COMMIT")
+            return None
+        connection.execute(
+            "UPDATE outbox SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (now, row["id"])
+        )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+    entry = row_to_entry(row)
+    entry["attempts"] += 1
+    return entry
+
+def is_error(result):
+    return isinstance(result, dict) and (result.get("status") == "error" or "error" in result)
+
+def failure_kind(result):
+    #None for a success, "transient" when cal.com refused or never saw the request, "ambiguous" when it
+    #may have acted on it (timeouts, dropped connections, 5xx, restarts) and "final" for everything that
+    #would fail the same way again (other 4xx, past times, bad event types, local exceptions)
+    if not is_error(result):
+        return None
+    status_code = result.get("status_code")
+    if status_code == 429:
+        return "transient"
+    if status_code is not None and status_code >= 500:
+        return "ambiguous"
+    failure = result.get("failure")
+    if failure == "connect":
+        return "transient"
+    if failure in ("timeout", "disconnect", "unknown"):
+        return "ambiguous"
+    return "final"
+
+def is_retryable(result, idempotent=True):
+    #an ambiguous failure is only sent again when doing so twice can't book twice
+    kind = failure_kind(result)
+    return kind == "transient" or (kind == "ambiguous" and idempotent)
+
+def finish(entry, status, result, next_attempt_at=None):
+    now = time.time()
+    get_connection().execute(
+        "UPDATE outbox SET status = ?, result = ?, updated_at = ?, next_attempt_at = ? WHERE id = ?",
+        (status, json.dumps(result), now, next_attempt_at or now, entry["id"])
+    )
+
+def process(entry):
+    name = entry["operation"]
+    operation = state["operations"][name]
+    reconcile = state["reconcilers"].get(name)
+    idempotent = name in state["idempotent"]
+    result = None
+    try:
+        with tenants.use_tenant(entry["tenant_id"]):
+            if not idempotent and failure_kind(entry["result"]) == "ambiguous":
+                #the last attempt may have gone through, so look for it before sending the request again,
+                #without a way to look the outcome stays unknown rather than risking a second booking
+                result = reconcile(entry["arguments"]) if reconcile else entry["result"]
+            if result is None:
+                result = operation(entry["arguments"])
+    except Exception as e:
+        result = {"error": f"Error executing {name}: {str(e)}", "status": "error"}
+
+    if is_retryable(result, idempotent or reconcile is not None) and entry["attempts"] < OUTBOX_MAX_ATTEMPTS:
+        delay = OUTBOX_RETRY_DELAY * (2 ** (entry["attempts"] - 1))
+        print(f"Outbox entry {entry['id']} failed (attempt {entry['attempts']}), retrying in {delay}s")
+        finish(entry, "pending", result, time.time() + delay)
+        return
+
+    failed = is_error(result)
+    if failed and failure_kind(result) == "ambiguous":
+        result = {**result, "error": f"{result['error']}. The request may still have gone through, check the calendar before trying again."}
+    finish(entry, "failed" if failed else "done", result)
+    entry["status"] = "failed" if failed else "done"
+    entry["result"] = result
+
+    if state["notify"]:
+        try:
+            state["notify"](entry, result)
+        except Exception as e:
+            print(f"Error notifying outbox result for {entry['id']}: {str(e)}")
+
+def worker_loop():
+    while not state["stopping"].is_set():
+        try:
+            entry = claim_next()
+        except sqlite3.Error as e:
+            print(f"Outbox worker could not claim an entry: {str(e)}")
+            entry = None
+
+        if entry is None:
+            state["wakeup"].wait(timeout=1.0)
+            state["wakeup"].clear()
+            continue
+
+        process(entry)
+
+def start(operations, notify=None, workers=None, idempotent=(), reconcilers=None):
+    #operations maps an operation name to a callable(arguments) returning the usual result dict
+    #idempotent names the operations that are safe to send twice, reconcilers maps the others to a
+    #callable(arguments) returning the result of an earlier attempt that went through, None if there was
+    #none, or an error result when that couldn't be checked
+    if state["workers"]:
+        return
+
+    state["operations"] = operations
+    state["idempotent"] = set(idempotent)
+    state["reconcilers"] = reconcilers or {}
+    state["notify"] = notify
+    state["stopping"].clear()
+    init_db()
+
+    for i in range(workers or OUTBOX_WORKERS):
+        worker = threading.Thread(target=worker_loop, name=f"outbox-worker-{i}", daemon=True)
+        worker.start()
+        state["workers"].append(worker)
+
+def stop(timeout=5.0):
+    state["stopping"].set()
+    state["wakeup"].set()
+    for worker in state["workers"]:
+        worker.join(timeout)
+    state["workers"] = []
@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import random
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#opt-in profiling of single chat turns: a wall-clock stack sampler plus a tracemalloc snapshot,
+#written as collapsed stacks (flamegraph.pl / speedscope ready) named after the turn's trace id
+#CHAT_PROFILE_SAMPLE_RATE profiles that fraction of turns, CHAT_PROFILE_USERS always profiles the listed users
+
+PROFILE_SAMPLE_RATE = float(os.getenv("CHAT_PROFILE_SAMPLE_RATE", "0") or 0)
+PROFILE_USERS = {user.strip() for user in os.getenv("CHAT_PROFILE_USERS", "").split(",") if user.strip()}
+PROFILE_DIR = os.getenv("CHAT_PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("CHAT_PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_TRACEBACK_DEPTH = int(os.getenv("CHAT_PROFILE_TRACEBACK_DEPTH", "25"))
+
+alloc_lock = threading.Lock()
+
+def should_profile(user_id, session=None):
+    if session is not None and session.get("profile"):
+        return True
+    if user_id in PROFILE_USERS:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+def collapse(frame):
+    stack = []
+    while frame is not None:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+def sample_thread(thread_id, samples, stop):
+    #only the turn's own thread is sampled, time spent waiting on the network shows up as socket frames
+    while not stop.wait(PROFILE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples[collapse(frame)] += 1
+
+def write_collapsed(path, counts):
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+
+def write_allocations(base_path, snapshot):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__)
+    ])
+    stats = snapshot.statistics("traceback")
+
+    #allocation flamegraph weighted by bytes still held at the end of the turn
+    counts = Counter()
+    for stat in stats:
+        frames = [f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in stat.traceback]
+        counts[";".join(frames)] += stat.size
+    write_collapsed(f"{base_path}.alloc.collapsed", counts)
+
+    with open(f"{base_path}.alloc.txt", "w", encoding="utf-8") as f:
+        total = sum(stat.size for stat in stats)
+        f.write(f"{total / 1024:.1f} KiB held in {sum(stat.count for stat in stats)} blocks at the end of the turn\n\n")
+        for stat in snapshot.statistics("lineno")[:50]:
+            f.write(f"{stat}\n")
+
+@contextmanager
+def profile_turn(trace_id, user_id, session=None):
+    #when the turn isn't picked this is one dict lookup and at most one random() call
+    if not should_profile(user_id, session):
+        yield None
+        return
+
+    samples = Counter()
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_thread, args=(threading.get_ident(), samples, stop), name=f"profiler-{trace_id}", daemon=True)
+
+    #tracemalloc is process wide, so only one turn at a time gets an allocation snapshot
+    trace_allocations = alloc_lock.acquire(blocking=False)
+    started_tracing = False
+    if trace_allocations and not tracemalloc.is_tracing():
+        tracemalloc.start(PROFILE_TRACEBACK_DEPTH)
+        started_tracing = True
+
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        yield trace_id
+    finally:
+        stop.set()
+        sampler.join()
+        duration_ms = (time.perf_counter() - started) * 1000
+        snapshot = tracemalloc.take_snapshot() if trace_allocations and tracemalloc.is_tracing() else None
+        if started_tracing:
+            tracemalloc.stop()
+        if trace_allocations:
+            alloc_lock.release()
+
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            base_path = os.path.join(PROFILE_DIR, trace_id)
+            write_collapsed(f"{base_path}.cpu.collapsed", samples)
+            if snapshot is not None:
+                write_allocations(base_path, snapshot)
+            print(f"Profiled turn {trace_id} for {user_id}: {duration_ms:.1f} ms, {sum(samples.values())} samples written to {base_path}.*")
+        except Exception as e:
+            print(f"Error writing profile for turn {trace_id}: {str(e)}")
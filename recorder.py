@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#the recorder captures everything a chat turn depends on (session state, model calls, tool calls and
+#cal.com requests with timings) as one JSONL line per turn, replay.py re-runs those lines offline
+
+current_turn = contextvars.ContextVar("recorded_turn", default=None)
+write_lock = threading.Lock()
+
+def record_path():
+    return os.getenv("CHAT_RECORD_PATH")
+
+def is_enabled():
+    return bool(record_path())
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+def to_jsonable(value):
+    #conversation history mixes plain dicts with the openai client's pydantic message objects
+    if hasattr(value, "model_dump"):
+        return value.model_dump(exclude_none=True)
+    if isinstance(value, dict):
+        return {key: to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(item) for item in value]
+    return value
+
+def redact_params(params):
+    if not params:
+        return params
+    return {key: ("***" if key == "apiKey" else value) for key, value in params.items()}
+
+def snapshot_session(session):
+    return {
+        "conversation_history": to_jsonable(session["conversation_history"]),
+        "pending_function": session["pending_function"],
+        "pending_params": to_jsonable(session["pending_params"]),
+        "tenant_id": session.get("tenant_id"),
+        "timezone": session.get("timezone"),
+        #outbox outcomes waiting to be merged into the history at the start of this turn
+        "queued_messages": to_jsonable(list(session.get("queued_messages") or []))
+    }
+
+@contextmanager
+def record_turn(trace_id, user_id, prompt, session):
+    #yields the turn being recorded, or None when recording is off so callers pay nothing
+    if not is_enabled():
+        yield None
+        return
+
+    turn = {
+        "trace_id": trace_id,
+        "user_id": user_id,
+        "prompt": prompt,
+        "started_at": time.time(),
+        "session": snapshot_session(session),
+        "llm_calls": [],
+        "tool_calls": [],
+        "http": [],
+        "deferred": [],
+        "response": None,
+        "cache_hit": False,
+        "error": None
+    }
+    token = current_turn.set(turn)
+    started = time.perf_counter()
+    try:
+        yield turn
+    except Exception as e:
+        turn["error"] = str(e)
+        raise
+    finally:
+        current_turn.reset(token)
+        turn["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        write_turn(turn)
+
+def write_turn(turn):
+    try:
+        line = json.dumps(turn, default=str)
+        with write_lock:
+            with open(record_path(), "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except Exception as e:
+        print(f"Error writing recorded turn {turn.get('trace_id')}: {str(e)}")
+
+def record(kind, entry):
+    #kind is one of llm_calls, tool_calls, http or deferred, a no-op outside a recorded turn
+    turn = current_turn.get()
+    if turn is not None:
+        turn[kind].append(to_jsonable(entry))
+
+def set_response(response):
+    turn = current_turn.get()
+    if turn is not None:
+        turn["response"] = response
+
+def mark_cache_hit():
+    #a turn answered from the response cache makes no model calls, replay needs to know why
+    turn = current_turn.get()
+    if turn is not None:
+        turn["cache_hit"] = True
+
+def load_turns(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+#replay must never call the real upstreams, record itself or write to the real outbox,
+#turns recorded in outbox mode get their recorded acknowledgements back from a stubbed defer hook
+os.environ.pop("CHAT_RECORD_PATH", None)
+os.environ.pop("CALCOM_OUTBOX_ENABLED", None)
+os.environ.setdefault("OPENAI_API_KEY", "replay")
+
+import requests
+from openai.types.chat import ChatCompletion
+import calcom_api
+import openai_functions
+import outbox
+import recorder
+import response_cache
+import tenants
+
+#usage: python replay.py turns.jsonl [--simulate-latency] [--json report.json]
+#re-runs every recorded turn against the current code with the model and cal.com stubbed from the log,
+#then reports per-turn latency deltas and where the behaviour no longer matches the recording
+
+class ReplayResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.text = body or ""
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error (replayed)", response=self)
+
+def comparable_request(params, body):
+    #the api key is redacted in the log and added below the stubbed calcom_request, so it never takes part
+    params = {key: value for key, value in (params or {}).items() if key != "apiKey"}
+    return recorder.to_jsonable(params), recorder.to_jsonable(body)
+
+class ReplayUpstreams:
+    def __init__(self, turn, simulate_latency=False):
+        self.llm_calls = turn["llm_calls"]
+        self.http_calls = turn["http"]
+        self.llm_used = [False] * len(self.llm_calls)
+        self.http_used = [False] * len(self.http_calls)
+        self.simulate_latency = simulate_latency
+        self.divergences = []
+        self.tool_calls = []
+        #every outbox acknowledgement is logged under deferred, older logs only show single deferred tool calls
+        if "deferred" in turn:
+            self.deferred = turn["deferred"]
+        else:
+            self.deferred = [call for call in turn["tool_calls"]
+                             if isinstance(call.get("result"), dict) and "request_id" in call["result"]]
+        self.deferred_used = [False] * len(self.deferred)
+        #a turn recorded as a cache hit is served its recorded answer, nothing else is ever read from the cache
+        self.cached_response = turn["response"] if turn.get("cache_hit") else None
+        self.cache_served = False
+        self.lock = threading.Lock()
+
+    def wait(self, recorded):
+        if self.simulate_latency:
+            time.sleep(recorded.get("duration_ms", 0) / 1000)
+
+    def chat_completion(self, **kwargs):
+        messages = recorder.to_jsonable(kwargs.get("messages"))
+        with self.lock:
+            #bulk tools format dates from worker threads, so match on the request rather than on order
+            index = next((i for i, call in enumerate(self.llm_calls)
+                          if not self.llm_used[i] and call["request"].get("messages") == messages), None)
+            if index is None:
+                index = next((i for i, used in enumerate(self.llm_used) if not used), None)
+                if index is None:
+                    self.divergences.append("model called more often than in the recording")
+                    raise RuntimeError("No recorded model response left to replay")
+                self.divergences.append(f"model request #{index + 1} differs from the recording")
+            self.llm_used[index] = True
+        recorded = self.llm_calls[index]
+        self.wait(recorded)
+        return ChatCompletion.model_validate(recorded["response"])
+
+    def calcom_request(self, method, url, api_version=None, params=None, json=None):
+        replayed_params, replayed_json = comparable_request(params, json)
+        with self.lock:
+            candidates = [i for i, call in enumerate(self.http_calls)
+                          if not self.http_used[i] and call["method"] == method and call["url"] == url]
+            if not candidates:
+                self.divergences.append(f"unrecorded Cal.com request {method} {url}")
+                return ReplayResponse(599, '{"error": "not in recording"}')
+            #pages of one listing share a url, so prefer the recorded request with the same filters and body
+            index = next((i for i in candidates
+                          if comparable_request(self.http_calls[i].get("params"), self.http_calls[i].get("json")) == (replayed_params, replayed_json)), None)
+            if index is None:
+                index = candidates[0]
+                recorded_params, recorded_json = comparable_request(self.http_calls[index].get("params"), self.http_calls[index].get("json"))
+                if recorded_params != replayed_params:
+                    self.divergences.append(f"Cal.com request {method} {url} params differ: recorded {recorded_params}, replayed {replayed_params}")
+                if recorded_json != replayed_json:
+                    self.divergences.append(f"Cal.com request {method} {url} body differs: recorded {recorded_json}, replayed {replayed_json}")
+            self.http_used[index] = True
+        recorded = self.http_calls[index]
+        self.wait(recorded)
+        if "error" in recorded and "status_code" not in recorded:
+            raise requests.exceptions.ConnectionError(recorded["error"])
+        return ReplayResponse(recorded["status_code"], recorded.get("body"))
+
+    def defer_to_outbox(self, user_id, function_name, arguments, tenant_id=None):
+        arguments = recorder.to_jsonable(arguments)
+        with self.lock:
+            candidates = [i for i, call in enumerate(self.deferred)
+                          if not self.deferred_used[i] and call["name"] == function_name]
+            if not candidates:
+                self.divergences.append(f"{function_name} was deferred to the outbox but not in the recording")
+                return {"error": "not deferred in recording", "status": "error"}
+            #bulk items are deferred from worker threads, so match on the arguments rather than on order
+            index = next((i for i in candidates if self.deferred[i]["arguments"] == arguments), None)
+            if index is None:
+                index = candidates[0]
+                self.divergences.append(f"{function_name} was deferred with different arguments: recorded {self.deferred[index]['arguments']}, replayed {arguments}")
+            self.deferred_used[index] = True
+        return self.deferred[index]["result"]
+
+    def cache_get(self, key):
+        if key is None or self.cached_response is None or self.cache_served:
+            return None
+        self.cache_served = True
+        return self.cached_response
+
+    def leftovers(self):
+        if self.cached_response is not None and not self.cache_served:
+            self.divergences.append("recorded response cache hit was not served")
+        unused_llm = self.llm_used.count(False)
+        if unused_llm:
+            self.divergences.append(f"{unused_llm} recorded model call(s) were not made")
+        for used, call in zip(self.deferred_used, self.deferred):
+            if not used:
+                self.divergences.append(f"recorded outbox deferral of {call['name']} was not made")
+        for used, call in zip(self.http_used, self.http_calls):
+            if not used:
+                self.divergences.append(f"recorded Cal.com request {call['method']} {call['url']} was not made")
+
+def tool_signature(calls):
+    return [(call["name"], json.dumps(call["arguments"], sort_keys=True)) for call in calls]
+
+def replay_turn(turn, simulate_latency=False):
+    upstreams = ReplayUpstreams(turn, simulate_latency)
+    original_handle = openai_functions.handle_function_call
+
+    def handle_function_call(function_name, arguments, user_prompt="", user_id=None):
+        result = original_handle(function_name, arguments, user_prompt, user_id)
+        upstreams.tool_calls.append({"name": function_name, "arguments": arguments})
+        return result
+
+    snapshot = turn["session"]
+    user_sessions = {
+        turn["user_id"]: {
+            "conversation_history": snapshot["conversation_history"],
+            "pending_function": snapshot["pending_function"],
+            "pending_params": snapshot["pending_params"],
+            "tenant_id": snapshot.get("tenant_id") or tenants.DEFAULT_TENANT,
+            "timezone": snapshot.get("timezone"),
+            "queued_messages": snapshot.get("queued_messages") or []
+        }
+    }
+    #fresh tenants per turn so one turn's caches can't hide another turn's requests
+    tenants.set_credential_provider(lambda tenant_id: "replay")
+
+    patches = [
+        (outbox, "is_enabled", lambda: bool(upstreams.deferred)),
+        (openai_functions, "defer_to_outbox", upstreams.defer_to_outbox),
+        (openai_functions, "chat_completion", upstreams.chat_completion),
+        (openai_functions, "handle_function_call", handle_function_call),
+        (response_cache, "get", upstreams.cache_get),
+        (response_cache, "put", lambda key, response: None),
+        (calcom_api, "calcom_request", upstreams.calcom_request)
+    ]
+    originals = [(module, name, getattr(module, name)) for module, name, _ in patches]
+    for module, name, stub in patches:
+        setattr(module, name, stub)
+
+    response = error = None
+    started = time.perf_counter()
+    try:
+        response = openai_functions.openai_function_calling(user_sessions, turn["user_id"], turn["prompt"], turn["trace_id"])
+    except Exception as e:
+        error = str(e)
+    finally:
+        replay_ms = (time.perf_counter() - started) * 1000
+        for module, name, original in originals:
+            setattr(module, name, original)
+
+    upstreams.leftovers()
+    divergences = upstreams.divergences
+    if tool_signature(upstreams.tool_calls) != tool_signature(turn["tool_calls"]):
+        divergences.append("tool calls differ: recorded "
+                           f"{[c['name'] for c in turn['tool_calls']]}, replayed {[c['name'] for c in upstreams.tool_calls]}")
+    if error != turn.get("error"):
+        divergences.append(f"error differs: recorded {turn.get('error')!r}, replayed {error!r}")
+    if response != turn.get("response"):
+        divergences.append("final response differs")
+
+    recorded_ms = turn.get("duration_ms", 0)
+    if not simulate_latency:
+        #stubs answer instantly, so compare against the time the turn spent outside the upstreams
+        upstream_ms = sum(c.get("duration_ms", 0) for c in turn["llm_calls"]) + sum(c.get("duration_ms", 0) for c in turn["http"])
+        recorded_ms = max(0.0, recorded_ms - upstream_ms)
+
+    return {
+        "trace_id": turn["trace_id"],
+        "user_id": turn["user_id"],
+        "recorded_ms": round(recorded_ms, 3),
+        "replay_ms": round(replay_ms, 3),
+        "delta_ms": round(replay_ms - recorded_ms, 3),
+        "divergences": divergences,
+        "response": response
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded chat turns against the current code.")
+    parser.add_argument("log", help="JSONL file written with CHAT_RECORD_PATH set")
+    parser.add_argument("--simulate-latency", action="store_true", help="sleep for the recorded upstream durations")
+    parser.add_argument("--json", dest="json_path", help="also write the full report to this file")
+    args = parser.parse_args(argv)
+
+    reports = [replay_turn(turn, args.simulate_latency) for turn in recorder.load_turns(args.log)]
+
+    print(f"{'trace_id':34} {'recorded ms':>12} {'replay ms':>12} {'delta ms':>12}  divergences")
+    for report in reports:
+        print(f"{report['trace_id']:34} {report['recorded_ms']:12.1f} {report['replay_ms']:12.1f} "
+              f"{report['delta_ms']:+12.1f}  {len(report['divergences'])}")
+        for divergence in report["divergences"]:
+            print(f"    - {divergence}")
+
+    diverged = sum(1 for report in reports if report["divergences"])
+    total_delta = sum(report["delta_ms"] for report in reports)
+    print(f"\n{len(reports)} turn(s) replayed, {diverged} diverged, total latency delta {total_delta:+.1f} ms")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+
+    return 1 if diverged else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
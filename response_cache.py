@@ -0,0 +1,211 @@
+import os
+import re
+import time
+import threading
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+from dotenv import load_dotenv
+import pytz
+import tenants
+
+load_dotenv()
+
+#caches final answers to repeated read-only questions ("what's on my calendar", "when is my next meeting")
+#keyed by user, normalized intent and the tenant's booking data version, so any mutation retires them
+
+CACHE_SIZE = int(os.getenv("CHAT_RESPONSE_CACHE_SIZE", "256"))
+CACHE_TTL = int(os.getenv("CHAT_RESPONSE_CACHE_TTL", "300"))
+
+#tools that only read booking data, a turn that ran anything else is never stored
+READ_ONLY_TOOLS = {"list_bookings"}
+
+#any of these words makes a prompt a possible mutation, and those never touch the cache
+MUTATION_WORDS = {
+    "book", "books", "booking", "bookings", "booked", "reserve", "reserved", "schedule", "scheduled",
+    "create", "add", "set", "setup", "arrange", "organise", "organize", "plan", "make", "put", "get",
+    "cancel", "cancelled", "delete", "remove", "drop", "clear", "decline",
+    "reschedule", "move", "change", "shift", "postpone", "push", "delay", "update", "edit", "modify",
+    "invite", "confirm", "accept", "need", "want", "like", "please", "can", "could", "would", "with"
+}
+#the only read phrasings allowed to contain booking/schedule words, matched on the normalized prompt
+READ_PHRASES = [
+    r"\b(show|list|view|see|display) (me )?(all )?my (upcoming )?(bookings|booking|schedule)\b",
+    r"\b(show|list|view|see|display) (me )?(all )?my (upcoming )?scheduled (events|meetings|calls|appointments)\b",
+    r"\bwhats on my (schedule|calendar)\b",
+    r"\bwhat is on my (schedule|calendar)\b"
+]
+BOOKING_NOUNS = {"calendar", "meetings", "meeting", "events", "event", "appointments", "appointment", "calls", "call"}
+READ_VERBS = {"show", "list", "view", "see", "what", "whats", "when", "whens", "display", "check", "any", "anything", "do", "have", "ive"}
+PERIODS = {
+    "today": "today", "tomorrow": "tomorrow",
+    "week": "week", "weekend": "weekend", "month": "month",
+    "monday": "monday", "tuesday": "tuesday", "wednesday": "wednesday", "thursday": "thursday",
+    "friday": "friday", "saturday": "saturday", "sunday": "sunday"
+}
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+#the only words a cacheable prompt may contain, everything the key can't express (last, past, after,
+#morning, did, and, ...) would change the answer without changing the key, so it rejects the prompt
+VOCABULARY = BOOKING_NOUNS | READ_VERBS | set(PERIODS) | {
+    "is", "are", "there", "i", "me", "my", "the", "a", "on", "in", "for", "all", "upcoming",
+    "coming", "up", "got", "help", "this", "next"
+}
+#statuses a read intent stands for, a turn that listed anything else answered a different question
+CACHEABLE_STATUSES = {"upcoming", "unconfirmed"}
+
+entries = OrderedDict()
+lock = threading.Lock()
+metrics = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "stale": 0}
+
+def is_enabled():
+    return CACHE_SIZE > 0
+
+def normalize_intent(prompt):
+    #maps a question onto a small set of read intents, anything that could be a mutation maps to None
+    if "@" in prompt or re.search(r"\d", prompt):
+        #specific people, dates or ids make the question too particular to share an answer
+        return None
+    text = " ".join(re.findall(r"[a-z]+", prompt.lower().replace("'", "")))
+    if not text:
+        return None
+
+    #allow-listed read phrasings are swapped for a plain read before the mutation check,
+    #every other use of a booking/schedule word rejects the prompt
+    for phrase in READ_PHRASES:
+        text = re.sub(phrase, " show calendar ", text)
+    words = text.split()
+    word_set = set(words)
+    if word_set & MUTATION_WORDS or not word_set <= VOCABULARY:
+        return None
+
+    for word, following in zip(words, words[1:] + [None]):
+        #"next" only ever means the next meeting and "this" only a period, "next week" has no intent
+        if word == "next" and following not in BOOKING_NOUNS:
+            return None
+        if word == "this" and following not in PERIODS:
+            return None
+    periods = {PERIODS[word] for word in words if word in PERIODS}
+    if len(periods) > 1:
+        return None
+    period = periods.pop() if periods else "any"
+
+    if "next" in word_set and word_set & BOOKING_NOUNS:
+        return f"next_meeting:{period}"
+    if word_set & BOOKING_NOUNS and word_set & READ_VERBS:
+        return f"list_bookings:{period}"
+    return None
+
+def local_today(timezone_str):
+    try:
+        return datetime.now(pytz.timezone(timezone_str)).date()
+    except (pytz.exceptions.UnknownTimeZoneError, AttributeError):
+        return None
+
+def make_key(user_id, prompt, timezone_str=None):
+    #the timezone is the one the user's last booking listing ran in, without it "today" is ambiguous
+    if not is_enabled() or not timezone_str:
+        return None
+    intent = normalize_intent(prompt)
+    today = local_today(timezone_str)
+    if intent is None or today is None:
+        return None
+    try:
+        tenant = tenants.get_tenant()
+    except ValueError:
+        return None
+    #relative periods like "today" mean something else tomorrow, so the user's local date is part of the key
+    return (tenant["id"], user_id, intent, tenant["data_version"], today.isoformat(), timezone_str)
+
+def period_window(period, today):
+    #first and last date a listing for this period may cover, None when the period is open-ended
+    if period == "today":
+        return today, today
+    if period == "tomorrow":
+        return today + timedelta(days=1), today + timedelta(days=1)
+    if period in WEEKDAYS:
+        day = today + timedelta(days=(WEEKDAYS.index(period) - today.weekday()) % 7)
+        return day, day
+    if period == "weekend":
+        if today.weekday() == 6:
+            return today, today
+        saturday = today + timedelta(days=(5 - today.weekday()) % 7)
+        return saturday, saturday + timedelta(days=1)
+    if period == "week":
+        monday = today - timedelta(days=today.weekday())
+        return monday, monday + timedelta(days=6)
+    if period == "month":
+        first = today.replace(day=1)
+        last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        return first, last
+    return None
+
+def get(key):
+    if key is None:
+        return None
+    with lock:
+        entry = entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del entries[key]
+            metrics["misses"] += 1
+            return None
+        entries.move_to_end(key)
+        metrics["hits"] += 1
+        return entry[1]
+
+def put(key, response):
+    if key is None or not response:
+        return
+    with lock:
+        #a key whose version is already behind the tenant's would never be read again
+        tenant = tenants.tenants.get(key[0])
+        if tenant is not None and tenant["data_version"] != key[3]:
+            metrics["stale"] += 1
+            return
+        entries[key] = (time.monotonic() + CACHE_TTL, response)
+        entries.move_to_end(key)
+        metrics["stores"] += 1
+        while len(entries) > CACHE_SIZE:
+            entries.popitem(last=False)
+            metrics["evictions"] += 1
+
+def matches_key(key, arguments):
+    #the model fills list_bookings from the whole conversation, so an attendee, status or date carried
+    #over from earlier turns would end up cached under a question that never asked for it
+    if arguments.get("attendee_email") or arguments.get("cursor"):
+        return False
+    if arguments.get("status") and not set(arguments["status"]) <= CACHEABLE_STATUSES:
+        return False
+    if arguments.get("attendee_timezone") != key[5]:
+        return False
+
+    today = date.fromisoformat(key[4])
+    window = period_window(key[2].split(":")[1], today)
+    first, last = window or (today, None)
+    for field in ("start_date", "end_date"):
+        value = arguments.get(field)
+        if value is None:
+            continue
+        day = date.fromisoformat(value)
+        if day < first or (last is not None and day > last) or (window is None and field == "end_date"):
+            return False
+    return True
+
+def is_cacheable_turn(key, tool_calls):
+    #tool_calls are (name, validated arguments) pairs, only answers backed by a fresh read of exactly
+    #what the key stands for are worth sharing, not ones the model made up from history
+    if key is None or not tool_calls:
+        return False
+    return all(name in READ_ONLY_TOOLS and matches_key(key, arguments) for name, arguments in tool_calls)
+
+def stats():
+    with lock:
+        lookups = metrics["hits"] + metrics["misses"]
+        return {
+            **metrics,
+            "size": len(entries),
+            "hit_rate": round(metrics["hits"] / lookups, 4) if lookups else 0.0
+        }
+
+def clear():
+    with lock:
+        entries.clear()
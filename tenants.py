@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import importlib
+import threading
+import contextvars
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#every cal.com account we talk to is a tenant with its own credentials, connection pool,
+#rate-limit bucket and cache namespace, so one busy account can't starve the others
+
+DEFAULT_TENANT = "default"
+POOL_SIZE = int(os.getenv("CALCOM_POOL_SIZE", "10"))
+RATE_LIMIT_PER_MINUTE = float(os.getenv("CALCOM_RATE_LIMIT_PER_MINUTE", "120"))
+RATE_LIMIT_BURST = float(os.getenv("CALCOM_RATE_LIMIT_BURST", "10"))
+
+tenants = {}
+tenants_lock = threading.Lock()
+current_tenant_id = contextvars.ContextVar("calcom_tenant_id", default=DEFAULT_TENANT)
+provider_state = {"provider": None}
+
+def env_credential_provider(tenant_id):
+    #CALCOM_API_KEYS is a JSON object of tenant id to api key, CALCOM_API_KEY is the default tenant's key
+    keys = json.loads(os.getenv("CALCOM_API_KEYS") or "{}")
+    if tenant_id in keys:
+        return keys[tenant_id]
+    if tenant_id == DEFAULT_TENANT:
+        return os.getenv("CALCOM_API_KEY")
+    return None
+
+def load_credential_provider():
+    #CALCOM_CREDENTIAL_PROVIDER="module:function" plugs in any callable(tenant_id) -> api key or None
+    path = os.getenv("CALCOM_CREDENTIAL_PROVIDER")
+    if not path:
+        return env_credential_provider
+    module_name, _, attribute = path.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+def set_credential_provider(provider):
+    with tenants_lock:
+        provider_state["provider"] = provider
+        tenants.clear()
+
+def get_credential_provider():
+    if provider_state["provider"] is None:
+        provider_state["provider"] = load_credential_provider()
+    return provider_state["provider"]
+
+def resolve_tenant_id(user_id):
+    #users with their own credentials get their own tenant, everyone else shares the default account
+    if user_id and user_id != DEFAULT_TENANT and get_credential_provider()(user_id):
+        return user_id
+    return DEFAULT_TENANT
+
+def create_tenant(tenant_id):
+    api_key = get_credential_provider()(tenant_id)
+    if not api_key:
+        raise ValueError(f"No Cal.com API key found for tenant '{tenant_id}'. Set CALCOM_API_KEY, CALCOM_API_KEYS or CALCOM_CREDENTIAL_PROVIDER.")
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return {
+        "id": tenant_id,
+        "api_key": api_key,
+        "session": session,
+        "bucket": {"tokens": RATE_LIMIT_BURST, "updated_at": time.monotonic()},
+        "cache": {},
+        "data_version": time.time_ns(),
+        "lock": threading.Lock()
+    }
+
+def get_tenant(tenant_id=None):
+    tenant_id = tenant_id or current_tenant_id.get()
+    tenant = tenants.get(tenant_id)
+    if tenant is None:
+        with tenants_lock:
+            tenant = tenants.get(tenant_id)
+            if tenant is None:
+                tenant = create_tenant(tenant_id)
+                tenants[tenant_id] = tenant
+    return tenant
+
+def forget_tenant(tenant_id):
+    #drops the pool and caches, e.g. after a key rotation, the next call resolves credentials again
+    with tenants_lock:
+        tenant = tenants.pop(tenant_id, None)
+    if tenant:
+        tenant["session"].close()
+
+@contextmanager
+def use_tenant(tenant_id):
+    #only selects the tenant, credentials are resolved by the first cal.com call that needs them,
+    #so a turn without tool calls still works when no key is configured
+    tenant_id = tenant_id or DEFAULT_TENANT
+    token = current_tenant_id.set(tenant_id)
+    try:
+        yield tenant_id
+    finally:
+        current_tenant_id.reset(token)
+
+def acquire(tenant):
+    #token bucket per tenant, waits outside the lock so other threads and tenants keep moving
+    rate = RATE_LIMIT_PER_MINUTE / 60.0
+    while True:
+        with tenant["lock"]:
+            bucket = tenant["bucket"]
+            now = time.monotonic()
+            bucket["tokens"] = min(RATE_LIMIT_BURST, bucket["tokens"] + (now - bucket["updated_at"]) * rate)
+            bucket["updated_at"] = now
+            if bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                return
+            wait = (1 - bucket["tokens"]) / rate
+        time.sleep(wait)
+
+def cache_get(tenant, namespace, key):
+    with tenant["lock"]:
+        entry = tenant["cache"].get(namespace, {}).get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del tenant["cache"][namespace][key]
+            return None
+        return value
+
+def cache_set(tenant, namespace, key, value, ttl):
+    with tenant["lock"]:
+        tenant["cache"].setdefault(namespace, {})[key] = (time.monotonic() + ttl, value)
+
+def cache_invalidate(tenant, *namespaces):
+    with tenant["lock"]:
+        for namespace in namespaces:
+            tenant["cache"].pop(namespace, None)
+
+def bump_data_version(tenant):
+    #anything keyed on the tenant's booking data (e.g. cached chat responses) goes stale with this
+    with tenant["lock"]:
+        tenant["data_version"] += 1
+        return tenant["data_version"]
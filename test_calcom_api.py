@@ -0,0 +1,104 @@
+import json
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+import calcom_api
+import tenants
+
+class FakeResponse:
+    def __init__(self, body):
+        self.status_code = 200
+        self.text = json.dumps(body)
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        pass
+
+def booking(i, email):
+    return {
+        "id": i,
+        "uid": f"uid-{i}",
+        "title": f"Meeting {i}",
+        "start": f"2031-01-{i:02d}T10:00:00.000Z",
+        "end": f"2031-01-{i:02d}T10:30:00.000Z",
+        "status": "accepted",
+        "attendees": [{"name": email, "email": email, "timeZone": "UTC"}]
+    }
+
+#fifteen upcoming bookings, every third one with bob, so filtered pages come back partly empty
+BOOKINGS = [booking(i, "bob@example.com" if i % 3 == 0 else "ann@example.com") for i in range(1, 16)]
+
+@pytest.fixture
+def upstream(monkeypatch):
+    #cal.com ignores the attendee filter here, so list_bookings has to filter and count positions itself
+    requests_made = []
+
+    def calcom_request(method, url, api_version=None, params=None, json=None):
+        requests_made.append(dict(params))
+        skip, take = params["skip"], params["take"]
+        return FakeResponse({"data": BOOKINGS[skip:skip + take]})
+
+    monkeypatch.setattr(calcom_api, "calcom_request", calcom_request)
+    monkeypatch.setattr(calcom_api, "BOOKINGS_PAGE_SIZE", 4)
+    tenants.set_credential_provider(lambda tenant_id: "test")
+    yield requests_made
+    tenants.set_credential_provider(None)
+
+def page_through(limit, **filters):
+    pages, cursor = [], None
+    while True:
+        result = calcom_api.list_bookings(status=["upcoming"], timezone_str="UTC", limit=limit, cursor=cursor, **filters)
+        assert result["status"] == "success"
+        pages.append([b["id"] for b in result["bookings"]])
+        cursor = result["next_cursor"]
+        if cursor is None:
+            return pages
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 4, 5, 7, 15, 100])
+def test_cursor_pages_cover_every_booking_once(upstream, limit):
+    pages = page_through(limit)
+    assert [i for page in pages for i in page] == list(range(1, 16))
+    assert all(len(page) == limit for page in pages[:-1])
+
+@pytest.mark.parametrize("limit", [1, 2, 4])
+def test_cursor_skips_filtered_bookings_across_upstream_pages(upstream, limit):
+    pages = page_through(limit, attendee_email="bob@example.com")
+    assert [i for page in pages for i in page] == [3, 6, 9, 12, 15]
+
+def test_cursor_points_at_the_next_match(upstream):
+    first = calcom_api.list_bookings(status=["upcoming"], attendee_email="bob@example.com", timezone_str="UTC", limit=2)
+    assert [b["id"] for b in first["bookings"]] == [3, 6]
+    #position of booking 9 in the unfiltered listing, so the next page starts right at it
+    assert first["next_cursor"] == "8"
+    assert upstream[-1]["skip"] == 8
+
+def test_date_range_is_bounded_on_start_and_widened_upstream(upstream):
+    result = calcom_api.list_bookings(start_date="2031-01-03", end_date="2031-01-04", timezone_str="UTC", limit=None)
+    assert [b["id"] for b in result["bookings"]] == [3, 4]
+    assert upstream[0]["afterStart"] == "2031-01-03T00:00:00.000Z"
+    assert upstream[0]["beforeEnd"] == "2031-01-06T00:00:00.000Z"
+
+def test_bad_cursor_is_an_error(upstream):
+    assert calcom_api.list_bookings(cursor="abc")["status"] == "error"
+    assert upstream == []
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(f"{status_code} Error", response=response)
+
+@pytest.mark.parametrize("error, failure", [
+    (http_error(429), {"status_code": 429}),
+    (http_error(503), {"status_code": 503}),
+    (http_error(400), {"status_code": 400}),
+    (requests.exceptions.ConnectTimeout("connect timed out"), {"failure": "connect"}),
+    (requests.exceptions.ConnectionError(MaxRetryError(None, "/", NewConnectionError(None, "refused"))), {"failure": "connect"}),
+    (requests.exceptions.ReadTimeout("read timed out"), {"failure": "timeout"}),
+    (requests.exceptions.ConnectionError("Connection aborted."), {"failure": "disconnect"})
+])
+def test_request_error_keeps_what_went_wrong(error, failure):
+    result = calcom_api.request_error("Failed to create booking", error)
+    assert result["status"] == "error" and result["error"].startswith("Failed to create booking: ")
+    assert {key: result[key] for key in ("status_code", "failure") if key in result} == failure
@@ -0,0 +1,118 @@
+import threading
+import pytest
+import outbox
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    #a fresh database and connection per test, with no workers so entries are processed by hand
+    monkeypatch.setattr(outbox, "OUTBOX_PATH", str(tmp_path / "outbox.db"))
+    monkeypatch.setattr(outbox, "OUTBOX_RETRY_DELAY", 0)
+    monkeypatch.setattr(outbox, "local", threading.local())
+    notified = []
+    monkeypatch.setitem(outbox.state, "notify", lambda entry, result: notified.append((entry["status"], result)))
+    monkeypatch.setitem(outbox.state, "idempotent", {"cancel_booking"})
+    monkeypatch.setitem(outbox.state, "reconcilers", {})
+    outbox.init_db()
+    return notified
+
+def use_operations(monkeypatch, **operations):
+    monkeypatch.setitem(outbox.state, "operations", operations)
+
+def test_identical_requests_share_one_entry(journal, monkeypatch):
+    use_operations(monkeypatch, cancel_booking=None)
+    first = outbox.enqueue("u1", "cancel_booking", {"booking_id": 7})
+    second = outbox.enqueue("u1", "cancel_booking", {"booking_id": 7})
+    assert second["duplicate"] and second["id"] == first["id"]
+
+@pytest.mark.parametrize("user_id, arguments, tenant_id", [
+    ("u2", {"booking_id": 7}, None),
+    ("u1", {"booking_id": 8}, None),
+    ("u1", {"booking_id": 7}, "acme")
+])
+def test_different_requests_get_their_own_entry(journal, monkeypatch, user_id, arguments, tenant_id):
+    use_operations(monkeypatch, cancel_booking=None)
+    first = outbox.enqueue("u1", "cancel_booking", {"booking_id": 7})
+    other = outbox.enqueue(user_id, "cancel_booking", arguments, tenant_id=tenant_id)
+    assert "duplicate" not in other and other["id"] != first["id"]
+
+def test_failed_entries_can_be_retried_by_the_user(journal, monkeypatch):
+    use_operations(monkeypatch, cancel_booking=lambda args: {"error": "Not found - Status: 404", "status": "error", "status_code": 404})
+    first = outbox.enqueue("u1", "cancel_booking", {"booking_id": 7})
+    outbox.process(outbox.claim_next())
+    again = outbox.enqueue("u1", "cancel_booking", {"booking_id": 7})
+    assert outbox.get_entry(first["id"])["status"] == "failed"
+    assert "duplicate" not in again and again["id"] != first["id"]
+
+def test_unknown_operations_are_refused(journal, monkeypatch):
+    use_operations(monkeypatch)
+    with pytest.raises(ValueError):
+        outbox.enqueue("u1", "cancel_booking", {"booking_id": 7})
+
+@pytest.mark.parametrize("result, kind", [
+    ({"status": "success"}, None),
+    ({"data": {"id": 1}}, None),
+    ({"error": "Too many requests", "status": "error", "status_code": 429}, "transient"),
+    ({"error": "refused", "status": "error", "failure": "connect"}, "transient"),
+    ({"error": "Bad gateway", "status": "error", "status_code": 502}, "ambiguous"),
+    ({"error": "read timed out", "status": "error", "failure": "timeout"}, "ambiguous"),
+    ({"error": "Connection aborted.", "status": "error", "failure": "disconnect"}, "ambiguous"),
+    (outbox.INTERRUPTED_RESULT, "ambiguous"),
+    ({"error": "Bad request", "status": "error", "status_code": 400}, "final"),
+    ({"error": "Booking time must be in the future.", "status": "error"}, "final"),
+    ({"error": "Invalid event type ID: x", "status": "error"}, "final"),
+    ({"status": "error", "message": "Failed to find or create event type"}, "final"),
+    ({"error": "Error executing create_booking: boom", "status": "error"}, "final")
+])
+def test_failure_kind(result, kind):
+    assert outbox.failure_kind(result) == kind
+    assert outbox.is_retryable(result) is (kind in ("transient", "ambiguous"))
+    assert outbox.is_retryable(result, idempotent=False) is (kind == "transient")
+
+def test_transient_failures_are_retried_until_they_succeed(journal, monkeypatch):
+    results = [{"error": "Too many requests", "status": "error", "status_code": 429}, {"status": "success"}]
+    use_operations(monkeypatch, create_booking=lambda args: results.pop(0))
+    entry = outbox.enqueue("u1", "create_booking", {"start_time": "2031-01-01T10:00:00.000Z"})
+    outbox.process(outbox.claim_next())
+    assert outbox.get_entry(entry["id"])["status"] == "pending" and journal == []
+    outbox.process(outbox.claim_next())
+    assert journal == [("done", {"status": "success"})]
+
+def test_deterministic_failures_are_reported_at_once(journal, monkeypatch):
+    calls = []
+    use_operations(monkeypatch, create_booking=lambda args: calls.append(args) or {"error": "Booking time must be in the future.", "status": "error"})
+    outbox.enqueue("u1", "create_booking", {"start_time": "2020-01-01T10:00:00.000Z"})
+    outbox.process(outbox.claim_next())
+    assert len(calls) == 1 and journal[0][0] == "failed"
+
+def test_ambiguous_create_is_looked_up_before_it_is_resent(journal, monkeypatch):
+    calls = []
+    use_operations(monkeypatch, create_booking=lambda args: calls.append(args) or {"error": "read timed out", "status": "error", "failure": "timeout"})
+    monkeypatch.setitem(outbox.state, "reconcilers", {"create_booking": lambda args: {"status": "success", "data": {"id": 9}}})
+    outbox.enqueue("u1", "create_booking", {"start_time": "2031-01-01T10:00:00.000Z"})
+    outbox.process(outbox.claim_next())
+    outbox.process(outbox.claim_next())
+    assert len(calls) == 1
+    assert journal == [("done", {"status": "success", "data": {"id": 9}})]
+
+def test_ambiguous_reschedule_is_not_resent(journal, monkeypatch):
+    calls = []
+    use_operations(monkeypatch, reschedule_booking=lambda args: calls.append(args) or {"error": "Bad gateway", "status": "error", "status_code": 502})
+    outbox.enqueue("u1", "reschedule_booking", {"booking_uid": "a"})
+    outbox.process(outbox.claim_next())
+    assert len(calls) == 1
+    status, result = journal[0]
+    assert status == "failed" and "may still have gone through" in result["error"]
+
+def test_entries_interrupted_by_a_restart_are_not_resent_blindly(journal, monkeypatch):
+    calls = []
+    use_operations(monkeypatch, reschedule_booking=lambda args: calls.append(args) or {"status": "success"}, cancel_booking=lambda args: calls.append(args) or {"status": "success"})
+    outbox.enqueue("u1", "reschedule_booking", {"booking_uid": "a"})
+    outbox.enqueue("u1", "cancel_booking", {"booking_id": 7})
+    outbox.claim_next()
+    outbox.claim_next()
+    outbox.init_db()
+
+    outbox.process(outbox.claim_next())
+    outbox.process(outbox.claim_next())
+    assert calls == [{"booking_id": 7}]
+    assert sorted(status for status, _ in journal) == ["done", "failed"]
@@ -0,0 +1,111 @@
+from datetime import date
+import pytest
+import response_cache
+
+#the normalizer decides which prompts may share a cached answer, so anything that could mutate must map to None
+@pytest.mark.parametrize("prompt, intent", [
+    ("What's on my calendar today?", "list_bookings:today"),
+    ("what is on my schedule tomorrow", "list_bookings:tomorrow"),
+    ("Show my bookings", "list_bookings:any"),
+    ("list my upcoming bookings this week", "list_bookings:week"),
+    ("help me view my upcoming scheduled events", "list_bookings:any"),
+    ("Do I have any meetings on friday?", "list_bookings:friday"),
+    ("What meetings do I have this week?", "list_bookings:week"),
+    ("When is my next meeting?", "next_meeting:any"),
+    ("what's my next call tomorrow", "next_meeting:tomorrow"),
+    ("When is my next meeting this week?", "next_meeting:week"),
+    ("Please schedule a meeting tomorrow, what do you need?", None),
+    ("Can you get me a meeting with Bob on friday?", None),
+    ("Reserve a meeting for me, what do I need", None),
+    ("Put a meeting on my calendar friday, what do you need", None),
+    ("Book a call tomorrow, what slots do I have?", None),
+    ("show my bookings and cancel the one tomorrow", None),
+    ("list my upcoming scheduled events with their UIDs for me to select one to cancel", None),
+    ("list my upcoming scheduled events with their UIDs for me to select one to reschedule", None),
+    ("what bookings do I have to move on friday", None),
+    ("Move my meeting tomorrow to friday", None),
+    ("What's on my schedule? Also set up a call", None),
+    ("What meetings do I have with bob@example.com?", None),
+    ("What's on my calendar on 2024-05-03?", None),
+    ("hello", None),
+    ("", None)
+])
+def test_normalize_intent(prompt, intent):
+    assert response_cache.normalize_intent(prompt) == intent
+
+#questions the intent can't tell apart from a cacheable one must not be cached at all
+@pytest.mark.parametrize("prompt", [
+    "What meetings did I have last week?",
+    "What's on my calendar the day after tomorrow?",
+    "Show my past meetings",
+    "What meetings do I have next week?",
+    "What's on my calendar tomorrow morning?",
+    "Any meetings tomorrow afternoon?",
+    "What's on my calendar today and tomorrow?",
+    "What's on my calendar tonight?"
+])
+def test_normalize_intent_rejects_what_the_key_cant_express(prompt):
+    assert response_cache.normalize_intent(prompt) is None
+
+#a wednesday, so this week runs from monday 2025-06-02 to sunday 2025-06-08
+TODAY = date(2025, 6, 4)
+
+@pytest.mark.parametrize("period, window", [
+    ("today", (date(2025, 6, 4), date(2025, 6, 4))),
+    ("tomorrow", (date(2025, 6, 5), date(2025, 6, 5))),
+    ("wednesday", (date(2025, 6, 4), date(2025, 6, 4))),
+    ("monday", (date(2025, 6, 9), date(2025, 6, 9))),
+    ("weekend", (date(2025, 6, 7), date(2025, 6, 8))),
+    ("week", (date(2025, 6, 2), date(2025, 6, 8))),
+    ("month", (date(2025, 6, 1), date(2025, 6, 30))),
+    ("any", None)
+])
+def test_period_window(period, window):
+    assert response_cache.period_window(period, TODAY) == window
+
+def key_for(intent):
+    return ("default", "u1", intent, 1, TODAY.isoformat(), "Europe/Berlin")
+
+def list_arguments(**overrides):
+    arguments = {"status": ["upcoming"], "start_date": None, "end_date": None, "attendee_email": None,
+                 "attendee_timezone": "Europe/Berlin", "limit": 20, "cursor": None}
+    arguments.update(overrides)
+    return arguments
+
+@pytest.mark.parametrize("intent, arguments, cacheable", [
+    ("list_bookings:today", list_arguments(start_date="2025-06-04", end_date="2025-06-04"), True),
+    ("list_bookings:friday", list_arguments(start_date="2025-06-06", end_date="2025-06-06"), True),
+    ("list_bookings:any", list_arguments(), True),
+    ("list_bookings:any", list_arguments(start_date="2025-06-04"), True),
+    ("list_bookings:week", list_arguments(status=None, start_date="2025-06-04", end_date="2025-06-08"), True),
+    ("list_bookings:today", list_arguments(start_date="2025-06-04", end_date="2025-06-04", attendee_email="bob@example.com"), False),
+    ("list_bookings:any", list_arguments(cursor="20"), False),
+    ("list_bookings:any", list_arguments(status=["past"]), False),
+    ("list_bookings:today", list_arguments(start_date="2025-06-04", end_date="2025-06-04", attendee_timezone="UTC"), False),
+    ("list_bookings:tomorrow", list_arguments(start_date="2025-06-06", end_date="2025-06-06"), False),
+    ("list_bookings:week", list_arguments(start_date="2025-05-26", end_date="2025-06-01"), False),
+    ("list_bookings:any", list_arguments(start_date="2025-06-06", end_date="2025-06-06"), False)
+])
+def test_is_cacheable_turn_checks_the_arguments_used(intent, arguments, cacheable):
+    assert response_cache.is_cacheable_turn(key_for(intent), [("list_bookings", arguments)]) is cacheable
+
+def test_is_cacheable_turn_needs_a_key_and_only_reads():
+    arguments = list_arguments()
+    assert not response_cache.is_cacheable_turn(None, [("list_bookings", arguments)])
+    assert not response_cache.is_cacheable_turn(key_for("list_bookings:any"), [])
+    assert not response_cache.is_cacheable_turn(key_for("list_bookings:any"), [("list_bookings", arguments), ("cancel_booking", {"booking_id": 1})])
+
+def test_make_key_needs_a_known_timezone():
+    assert response_cache.make_key("u1", "What's on my calendar today?") is None
+    assert response_cache.make_key("u1", "What's on my calendar today?", "Not/AZone") is None
+
+def test_make_key_uses_the_users_local_date():
+    tenants = response_cache.tenants
+    tenants.set_credential_provider(lambda tenant_id: "test")
+    try:
+        key = response_cache.make_key("u1", "What's on my calendar today?", "Pacific/Kiritimati")
+    finally:
+        tenants.set_credential_provider(None)
+    assert key[2] == "list_bookings:today"
+    assert key[4] == response_cache.local_today("Pacific/Kiritimati").isoformat()
+    assert key[5] == "Pacific/Kiritimati"
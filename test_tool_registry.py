@@ -0,0 +1,74 @@
+import pytest
+import tool_registry
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "booking_id": {"type": "integer"},
+        "status": {"type": ["array", "null"], "items": {"type": "string", "enum": ["upcoming", "past"]}},
+        "cursor": {"type": ["string", "null"]},
+        "bookings": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"booking_uid": {"type": "string"}},
+                "required": ["booking_uid"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["booking_id", "status", "cursor", "bookings"],
+    "additionalProperties": False
+}
+
+validate = tool_registry.compile_object(SCHEMA)
+
+def arguments(**overrides):
+    value = {"booking_id": 1, "status": None, "cursor": None, "bookings": []}
+    value.update(overrides)
+    return value
+
+@pytest.mark.parametrize("booking_id, expected", [(7, 7), (7.0, 7), ("7", 7), (" 12 ", 12), ("-3", -3)])
+def test_integers_are_coerced(booking_id, expected):
+    assert validate(arguments(booking_id=booking_id))["booking_id"] == expected
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"booking_id": True}, "booking_id must be an integer"),
+    ({"booking_id": 7.5}, "booking_id must be an integer"),
+    ({"booking_id": "seven"}, "booking_id must be an integer"),
+    ({"booking_id": None}, "booking_id must not be null"),
+    ({"status": "upcoming"}, "status must be a list"),
+    ({"status": ["soon"]}, "status[] must be one of upcoming, past"),
+    ({"cursor": 20}, "cursor must be a string"),
+    ({"bookings": [{}]}, "missing required field(s) booking_uid in bookings[]"),
+    ({"bookings": [{"booking_uid": "a", "when": "now"}]}, "unexpected field(s) when in bookings[]"),
+    ({"extra": 1}, "unexpected field(s) extra")
+])
+def test_invalid_arguments_name_the_field(overrides, message):
+    with pytest.raises(ValueError) as error:
+        validate(arguments(**overrides))
+    assert str(error.value).startswith(message)
+
+def test_missing_top_level_fields_are_listed():
+    with pytest.raises(ValueError, match="missing required field\\(s\\) status, cursor"):
+        validate({"booking_id": 1, "bookings": []})
+
+def test_nullable_and_enum_values_pass_through():
+    checked = validate(arguments(status=["upcoming", "past"], cursor="40", bookings=[{"booking_uid": "a"}]))
+    assert checked == {"booking_id": 1, "status": ["upcoming", "past"], "cursor": "40", "bookings": [{"booking_uid": "a"}]}
+
+def test_dispatch_rejects_bad_arguments_before_the_handler(monkeypatch):
+    calls = []
+    monkeypatch.setattr(tool_registry, "tools", {})
+    tool_registry.register_tool(
+        schema={"type": "function", "function": {"name": "cancel_booking", "parameters": SCHEMA}},
+        handler=lambda args, context: calls.append(args) or {"status": "success"},
+        mutation=True
+    )
+    result = tool_registry.dispatch("cancel_booking", arguments(booking_id="nope"))
+    assert result["status"] == "error" and result["error"].startswith("Invalid arguments for cancel_booking")
+    assert calls == []
+
+    deferred = tool_registry.dispatch("cancel_booking", arguments(booking_id="3"), {"defer": lambda name, args: {"status": "queued", "args": args}})
+    assert deferred == {"status": "queued", "args": arguments(booking_id=3)}
+    assert calls == []
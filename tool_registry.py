@@ -0,0 +1,135 @@
+#the tool registry keeps every tool's OpenAI schema, argument coercion and handler in one place
+#validators are compiled from the JSON schema once at registration so a tool call costs a dict lookup
+
+tools = {}
+
+def type_names(spec):
+    declared = spec.get("type", [])
+    return declared if isinstance(declared, list) else [declared]
+
+def compile_type_check(spec, path):
+    names = type_names(spec)
+    nullable = "null" in names
+    names = [name for name in names if name != "null"]
+    base = names[0] if names else None
+    enum = spec.get("enum")
+
+    if base == "object":
+        inner = compile_object(spec, path)
+    elif base == "array":
+        item_check = compile_type_check(spec.get("items", {}), f"{path}[]")
+
+        def inner(value):
+            if not isinstance(value, list):
+                raise ValueError(f"{path} must be a list")
+            return [item_check(item) for item in value]
+    elif base == "integer":
+        def inner(value):
+            if isinstance(value, bool):
+                raise ValueError(f"{path} must be an integer")
+            if isinstance(value, int):
+                return value
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+                return int(value.strip())
+            raise ValueError(f"{path} must be an integer, got {value!r}")
+    elif base == "string":
+        def inner(value):
+            if not isinstance(value, str):
+                raise ValueError(f"{path} must be a string, got {value!r}")
+            return value
+    else:
+        def inner(value):
+            return value
+
+    def check(value):
+        if value is None:
+            if nullable:
+                return None
+            raise ValueError(f"{path} must not be null")
+        value = inner(value)
+        if enum is not None and value not in enum:
+            raise ValueError(f"{path} must be one of {', '.join(map(str, enum))}, got {value!r}")
+        return value
+
+    return check
+
+def compile_object(spec, path=""):
+    properties = spec.get("properties", {})
+    checks = {name: compile_type_check(prop, f"{path}.{name}" if path else name) for name, prop in properties.items()}
+    required = tuple(spec.get("required", []))
+    closed = spec.get("additionalProperties", True) is False
+
+    def check(value):
+        if not isinstance(value, dict):
+            raise ValueError(f"{path or 'arguments'} must be an object")
+        missing = [name for name in required if name not in value]
+        if missing:
+            raise ValueError(f"missing required field(s) {', '.join(missing)}" + (f" in {path}" if path else ""))
+        if closed:
+            unknown = [name for name in value if name not in checks]
+            if unknown:
+                raise ValueError(f"unexpected field(s) {', '.join(unknown)}" + (f" in {path}" if path else ""))
+        return {name: checks[name](item) if name in checks else item for name, item in value.items()}
+
+    return check
+
+def register_tool(schema, handler, coerce=None, mutation=False):
+    #coerce(arguments) runs after schema validation and may normalise values or raise ValueError
+    #handler(arguments, context) does the actual work and returns the usual result dict
+    #mutation marks tools that change bookings, those can be deferred to the outbox
+    name = schema["function"]["name"]
+    parameters = schema["function"].get("parameters", {})
+    tools[name] = {
+        "schema": schema,
+        "required": tuple(parameters.get("required", [])),
+        "validate": compile_object(parameters),
+        "coerce": coerce,
+        "handler": handler,
+        "mutation": mutation
+    }
+
+def tool_schemas():
+    return [tool["schema"] for tool in tools.values()]
+
+def is_registered(name):
+    return name in tools
+
+def is_mutation(name):
+    return name in tools and tools[name]["mutation"]
+
+def missing_fields(name, arguments):
+    tool = tools.get(name)
+    if tool is None:
+        return []
+    return [field for field in tool["required"] if field not in arguments]
+
+def validate_arguments(name, arguments):
+    tool = tools[name]
+    arguments = tool["validate"](arguments)
+    if tool["coerce"]:
+        arguments = tool["coerce"](arguments)
+    return arguments
+
+def dispatch(name, arguments, context=None):
+    tool = tools.get(name)
+    if tool is None:
+        return {"error": f"Unknown function: {name}"}
+
+    #bad arguments are rejected here, before any network call, with a message the model can act on
+    try:
+        arguments = validate_arguments(name, arguments)
+    except ValueError as e:
+        return {"error": f"Invalid arguments for {name}: {str(e)}. Fix the arguments and call {name} again.", "status": "error"}
+
+    context = context or {}
+    #a defer hook in the context hands validated mutations off instead of running them inline
+    if tool["mutation"] and context.get("defer"):
+        return context["defer"](name, arguments)
+
+    return tool["handler"](arguments, context)
+
+def run_handler(name, arguments, context=None):
+    #runs a tool on arguments that were already validated, e.g. when replaying a journaled mutation
+    return tools[name]["handler"](arguments, context or {})